@@ -0,0 +1,370 @@
+"""
+Gemini Analysis Service
+Caches mood/palette analysis per photo + prompt, coalesces duplicate in-flight calls,
+and guards the model with a deadline and a circuit breaker
+"""
+
+import io
+import os
+import copy
+import json
+import time
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from PIL import Image, ImageOps
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+
+ANALYSIS_IMAGE_SIZE = int(os.getenv("ANALYSIS_IMAGE_SIZE", "768"))
+ANALYSIS_IMAGE_QUALITY = int(os.getenv("ANALYSIS_IMAGE_QUALITY", "85"))
+
+
+@dataclass
+class AnalysisImage:
+    """Bounded-size JPEG sent to the model, plus its decoded pixels for the cache key"""
+    jpeg: bytes
+    image: Image.Image
+
+    def as_part(self) -> dict:
+        # An inline blob is sent as-is; a PIL image would be re-encoded as lossless WebP
+        return {"mime_type": "image/jpeg", "data": self.jpeg}
+
+
+def prepare_analysis_image(photo_bytes: bytes, max_side: Optional[int] = None,
+                           quality: Optional[int] = None) -> AnalysisImage:
+    """
+    Mood and palette detection does not need a 12MP upload: decode at a reduced
+    JPEG DCT scale, apply EXIF orientation and re-encode at most `max_side` px.
+    """
+    max_side = max_side or ANALYSIS_IMAGE_SIZE
+    quality = quality or ANALYSIS_IMAGE_QUALITY
+
+    img = Image.open(io.BytesIO(photo_bytes))
+    if img.format == "JPEG":
+        img.draft("RGB", (max_side, max_side))
+    img = ImageOps.exif_transpose(img).convert("RGB")
+    img.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=quality)
+    return AnalysisImage(jpeg=buf.getvalue(), image=img)
+
+
+def perceptual_hash(image: Image.Image, hash_size: int = 8) -> str:
+    """
+    64-bit difference hash (dHash): stable across re-encodes, resizes and EXIF
+    stripping, so the same photo re-uploaded by a client maps to the same key.
+    """
+    small = image.convert("L").resize((hash_size + 1, hash_size), Image.Resampling.BILINEAR)
+    pixels = list(small.getdata())
+    bits = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            bits = (bits << 1) | (1 if left > right else 0)
+    return f"{bits:0{hash_size * hash_size // 4}x}"
+
+
+def analysis_key(image_hash: str, theme: str, prompt: str) -> str:
+    prompt_hash = hashlib.sha256(prompt.encode()).hexdigest()[:16]
+    return f"{image_hash}|{theme.lower()}|{prompt_hash}"
+
+
+class AnalysisCache:
+    """LRU of analysis results with a time-to-live per entry"""
+
+    def __init__(self, max_entries: Optional[int] = None, ttl: Optional[float] = None):
+        self.max_entries = max_entries or int(os.getenv("ANALYSIS_CACHE_SIZE", "512"))
+        self.ttl = ttl if ttl is not None else float(os.getenv("ANALYSIS_CACHE_TTL", "3600"))
+        self._entries = OrderedDict()  # key -> (expires_at, analysis)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return copy.deepcopy(entry[1])
+
+    def put(self, key: str, analysis: dict):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, copy.deepcopy(analysis))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+class CircuitOpen(Exception):
+    """The breaker refused the call; serve the fallback without waiting"""
+
+
+class SingleFlight:
+    """
+    Run at most one call per key at a time; concurrent callers await the same result.
+    The call runs as its own task: a cancelled caller only leaves, and the call is
+    cancelled once no caller is left waiting for it.
+    """
+
+    def __init__(self):
+        self._inflight: Dict[str, list] = {}  # key -> [task, waiters]
+        self.coalesced = 0
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        flight = self._inflight.get(key)
+        if flight is not None:
+            self.coalesced += 1
+        else:
+            flight = [asyncio.ensure_future(fn()), 0]
+            self._inflight[key] = flight
+            flight[0].add_done_callback(lambda task: self._landed(key, task))
+
+        task = flight[0]
+        flight[1] += 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            flight[1] -= 1
+            if flight[1] == 0 and not task.done():
+                # Nobody left to answer; a new caller starts a fresh call
+                self._forget(key, task)
+                task.cancel()
+
+    def _forget(self, key: str, task: asyncio.Future):
+        if self._inflight.get(key, [None])[0] is task:
+            del self._inflight[key]
+
+    def _landed(self, key: str, task: asyncio.Future):
+        self._forget(key, task)
+        if not task.cancelled():
+            # Mark retrieved so a failure nobody else awaited is not logged as lost
+            task.exception()
+
+
+class CircuitBreaker:
+    """
+    Classic three-state breaker around the model call.
+    - closed: calls go through; `failure_threshold` consecutive failures open it
+    - open: calls are refused for `cooldown` seconds (instant fallback)
+    - half_open: one probe call is let through; success closes, failure re-opens
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: Optional[int] = None, cooldown: Optional[float] = None):
+        self.failure_threshold = failure_threshold or int(os.getenv("GEMINI_BREAKER_FAILURES", "3"))
+        self.cooldown = cooldown if cooldown is not None else float(os.getenv("GEMINI_BREAKER_COOLDOWN", "60"))
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.times_opened = 0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.cooldown:
+                    return False
+                print("LOG: Gemini circuit half-open, sending a probe request...")
+                self.state = self.HALF_OPEN
+                self._probe_in_flight = False
+            # Half-open: exactly one probe at a time
+            if self._probe_in_flight:
+                return False
+            self._probe_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                print("LOG: Gemini circuit closed, AI analysis is back")
+            self.state = self.CLOSED
+            self.failures = 0
+            self._probe_in_flight = False
+
+    def release_probe(self):
+        """The call was abandoned (e.g. its request was cancelled): no verdict, let the next call probe"""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probe_in_flight = False
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.times_opened += 1
+                    print(f"WARNING: Gemini circuit OPEN for {self.cooldown:.0f}s after {self.failures} failures. Rendering with fallback analysis.")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def stats(self) -> dict:
+        with self._lock:
+            retry_in = 0.0
+            if self.state == self.OPEN:
+                retry_in = max(0.0, self.cooldown - (time.monotonic() - self.opened_at))
+            return {
+                "state": self.state,
+                "consecutive_failures": self.failures,
+                "failure_threshold": self.failure_threshold,
+                "cooldown_seconds": self.cooldown,
+                "retry_in_seconds": round(retry_in, 1),
+                "times_opened": self.times_opened,
+            }
+
+
+def build_prompt(theme: str) -> str:
+    return f"""
+AS AN ELITE CREATIVE DIRECTOR:
+Analyze this image. Return STRICT JSON: {{ "dominantEmotion": "", "vibeDescription": "", "collageStyle": "{theme}", "emotions": [], "colorPalette": [] }}
+Theme: {theme}
+"""
+
+
+def fallback_analysis(theme: str) -> dict:
+    """Premium pre-defined vibe used whenever the model cannot answer"""
+    return {
+        "dominantEmotion": "Timeless",
+        "vibeDescription": "A curated visual story by Mood Snap",
+        "collageStyle": theme if theme in ["scrapbook", "magazine", "moodboard", "filmstrip", "doodle"] else "magazine",
+        "emotions": ["Elegant", "Captured", "Artisanal"],
+        "colorPalette": ["#2D3436", "#636E72", "#B2BEC3", "#DFE6E9", "#FFFFFF"]
+    }
+
+
+class AnalysisService:
+    """Gemini mood analysis with result caching, request coalescing, a deadline and a breaker"""
+
+    def __init__(self, model, cache: Optional[AnalysisCache] = None,
+                 breaker: Optional[CircuitBreaker] = None, timeout: Optional[float] = None):
+        self.model = model
+        self.cache = cache or AnalysisCache()
+        self.flights = SingleFlight()
+        self.breaker = breaker or CircuitBreaker()
+        self.timeout = timeout or float(os.getenv("GEMINI_TIMEOUT", "20"))
+
+        self.calls = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.short_circuited = 0
+        self.fallbacks = 0
+        self.last_latency_ms = None
+        self.avg_latency_ms = None
+
+    async def analyze(self, image: AnalysisImage, theme: str, prompt: str) -> dict:
+        """
+        Analysis for `image` (see prepare_analysis_image); cached results are returned
+        immediately and identical concurrent requests share one model call.
+        Falls back on any model failure.
+        """
+        key = analysis_key(perceptual_hash(image.image), theme, prompt)
+
+        cached = self.cache.get(key)
+        if cached is not None:
+            print(f"LOG: AI Analysis cache hit -> {cached.get('dominantEmotion', 'Unknown')}")
+            return cached
+
+        try:
+            analysis = await self.flights.do(key, lambda: self._guarded_generate(key, image, prompt))
+            return copy.deepcopy(analysis)
+        except CircuitOpen:
+            self.short_circuited += 1
+            print("WARNING: Gemini circuit open. Activating Artisanal Fallback instantly.")
+        except Exception as ai_err:
+            print(f"WARNING: AI Studio Busy or Quota Limit Hit. Activating Artisanal Fallback. ({ai_err})")
+
+        # We don't fail, we just use a premium pre-defined vibe
+        self.fallbacks += 1
+        return fallback_analysis(theme)
+
+    async def _guarded_generate(self, key: str, image: AnalysisImage, prompt: str) -> dict:
+        """One model call under the breaker and a hard deadline"""
+        if not self.breaker.allow():
+            raise CircuitOpen()
+
+        self.calls += 1
+        start = time.monotonic()
+        try:
+            analysis = await asyncio.wait_for(self._generate(image, prompt), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            self.failures += 1
+            self.breaker.record_failure()
+            raise TimeoutError(f"Gemini did not answer within {self.timeout:.0f}s")
+        except Exception:
+            self.failures += 1
+            self.breaker.record_failure()
+            raise
+        except BaseException:
+            # Cancelled: says nothing about the model, but must not leave a half-open probe held
+            self.breaker.release_probe()
+            raise
+        finally:
+            self._record_latency(time.monotonic() - start)
+
+        self.breaker.record_success()
+        self.cache.put(key, analysis)
+        return analysis
+
+    async def _generate(self, image: AnalysisImage, prompt: str) -> dict:
+        print(f"LOG: Requesting AI Analysis (Gemini) with a {image.image.width}x{image.image.height} "
+              f"preview ({len(image.jpeg) // 1024} KB)...")
+        # The SDK call is blocking; keep it off the event loop
+        response = await asyncio.to_thread(
+            self.model.generate_content, [prompt, image.as_part()],
+            request_options={"timeout": self.timeout}
+        )
+        # If AI is blocked, accessing .text will raise an exception
+        raw_text = response.text.replace("```json", "").replace("```", "").strip()
+        analysis = json.loads(raw_text)
+        print(f"LOG: AI Analysis Success -> {analysis.get('dominantEmotion', 'Unknown')}")
+        return analysis
+
+    def _record_latency(self, seconds: float):
+        latency_ms = seconds * 1000.0
+        self.last_latency_ms = round(latency_ms, 1)
+        if self.avg_latency_ms is None:
+            self.avg_latency_ms = self.last_latency_ms
+        else:
+            # Exponentially weighted, so the number tracks the current state of the API
+            self.avg_latency_ms = round(0.8 * self.avg_latency_ms + 0.2 * latency_ms, 1)
+
+    def stats(self) -> dict:
+        return {
+            "cache": self.cache.stats(),
+            "coalesced": self.flights.coalesced,
+            "breaker": self.breaker.stats(),
+            "timeout_seconds": self.timeout,
+            "calls": self.calls,
+            "failures": self.failures,
+            "timeouts": self.timeouts,
+            "short_circuited": self.short_circuited,
+            "fallbacks": self.fallbacks,
+            "last_latency_ms": self.last_latency_ms,
+            "avg_latency_ms": self.avg_latency_ms,
+        }
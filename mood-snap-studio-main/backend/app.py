@@ -1,12 +1,17 @@
 import os
-import io
 import json
+import time
+import uuid
+import random
 import base64
-from fastapi import FastAPI, UploadFile, File, Form
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Optional
+from fastapi import FastAPI, UploadFile, File, Form, Header, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 import google.generativeai as genai
 from dotenv import load_dotenv
-from PIL import Image
 from pathlib import Path
 
 # =========================
@@ -26,10 +31,56 @@ genai.configure(api_key=api_key)
 # =========================
 model = genai.GenerativeModel("gemini-flash-latest")
 
+# =========================
+# ANALYSIS SERVICE
+# =========================
+from analysis_service import AnalysisService, build_prompt, prepare_analysis_image
+
+analysis_service = AnalysisService(model)
+
+# =========================
+# RENDER POOL
+# =========================
+from render_pool import RenderPool, RenderPoolSaturated, RenderPoolUnavailable
+from image_engine import warm_up_rembg
+from layer_cache import get_layer_cache
+
+# Each worker loads and warms its background removal sessions on start
+render_pool = RenderPool(initializer=warm_up_rembg)
+
+# =========================
+# COLLAGE OUTPUT STORE
+# =========================
+from collage_output import CollageStore, EncoderSaturated, OUTPUT_FORMATS, negotiate_format, snap_quality, encode_image
+
+# Rendered collages are kept (TTL + size bound) for binary download via GET /collage/{id}.
+# They live in this process: run one API worker (see CollageStore)
+collage_store = CollageStore()
+
+# =========================
+# JOB STORE
+# =========================
+from job_store import JobStore, JobRunner, QUEUED, DONE, FINISHED
+
+# Queued/finished render jobs for the asynchronous /jobs API (SQLite + files on disk)
+job_store = JobStore()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if int(os.getenv("WEB_CONCURRENCY", "1")) > 1:
+        print("WARNING: Several API workers: a collage can only be downloaded or edited through "
+              "the worker that rendered it; run one worker and raise RENDER_WORKERS instead")
+    render_pool.start()
+    job_runner.start()
+    yield
+    await job_runner.stop()
+    render_pool.shutdown()
+
 # =========================
 # FASTAPI APP
 # =========================
-app = FastAPI(title="Mood Snap Studio – AI Brain")
+app = FastAPI(title="Mood Snap Studio – AI Brain", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -54,70 +105,193 @@ def root():
     
     return status
 
+
+@app.get("/stats")
+def stats():
+    result = {
+        "render_pool": render_pool.stats(),
+        "analysis": analysis_service.stats(),
+        "collage_store": collage_store.stats(),
+        "job_store": job_store.stats(),
+    }
+    if render_pool.kind == "thread":
+        # Process workers keep their own caches (they log stats per render)
+        result["layer_cache"] = get_layer_cache().stats()
+    return result
+
 # =========================
 # IMAGE ENGINE IMPORTS
 # =========================
-from collage_engine import create_collage_from_analysis
+from collage_engine import (
+    render_collage_from_analysis, render_collages_from_analysis, prepare_collage, template_for_analysis,
+    render_editable_collage, rerender_collage, spec_for_analysis, render_from_spec,
+    validate_spec, RenderStateMissing
+)
+from render_spec import RenderSpec
+from layer_cache import photo_digest
+from collage_templates import get_template_by_style
 
 # =========================
 # MAIN ENDPOINT
 # =========================
+async def _reconcile_prepared(speculative_task: asyncio.Task, predicted, template):
+    """
+    Result of the speculative render if it was for `template`, otherwise None.
+    A wrong guess is cancelled (a render already on a worker runs out and keeps
+    its pool slot until then); a failed one just means a full render. The prepared
+    canvas only exists in the layer cache of the worker that built it: finish it
+    with the same render pool affinity key.
+    """
+    if predicted != template:
+        print(f"LOG: Analysis picked '{template.name}' over the predicted '{predicted.name}', discarding speculative render")
+        speculative_task.cancel()
+        return None
+    try:
+        return await speculative_task
+    except Exception as e:
+        print(f"WARNING: Speculative render unavailable, rendering from scratch: {e}")
+        return None
+
+
+async def _read_uploads(files: list[UploadFile], theme: str):
+    """
+    Read every upload. STEP 1, the Gemini analysis (cached, coalesced, with surgical
+    fallback for rate limits) of a small preview of the first photo, starts as soon
+    as that photo has arrived, so the model round-trip overlaps with local work.
+    """
+    photo_bytes_list = []
+    analysis_task = None
+    try:
+        for file in files:
+            contents = await file.read()
+            photo_bytes_list.append(contents)
+            print(f"LOG: Photo {len(photo_bytes_list)} - {len(contents)} bytes")
+
+            if analysis_task is None:
+                preview = await asyncio.to_thread(prepare_analysis_image, contents)
+                analysis_task = asyncio.create_task(
+                    analysis_service.analyze(preview, theme, build_prompt(theme))
+                )
+    except BaseException:
+        if analysis_task is not None:
+            analysis_task.cancel()
+        raise
+    return photo_bytes_list, analysis_task
+
+
+async def _publish_collage(collage, inline_image: bool, state=None, spec_hash: Optional[str] = None) -> dict:
+    """
+    STEP 3: Store the thumb/social/full pyramid; small sizes start encoding right away,
+    full size only when asked for. Returns the collage fields of the response
+    (plus edit_url when a render state is kept for POST /collage/{id}/edit).
+    A `spec_hash` makes the collage available as GET /render/{spec_hash}.
+    """
+    collage_id = await collage_store.run(collage_store.put, collage, state, spec_hash)
+    collage_store.prefetch(collage_id)
+    return await _collage_fields(collage_id, inline_image, editable=state is not None)
+
+
+async def _collage_fields(collage_id: str, inline_image: bool, editable: bool = False) -> dict:
+    """Response fields describing a stored collage"""
+    derivatives = {
+        name: {"url": f"/collage/{collage_id}?size={name}", "width": w, "height": h}
+        for name, (w, h) in collage_store.sizes(collage_id).items()
+    }
+
+    # Inline PNG data URL for existing clients; others pass inline_image=false
+    # and download GET /collage/{id} in the size and format they need
+    collage_image = None
+    if inline_image:
+        collage_bytes = await collage_store.run(collage_store.encoded, collage_id, "png")
+        collage_image = f"data:image/png;base64,{base64.b64encode(collage_bytes).decode()}"
+
+    published = {
+        "collage_image": collage_image,
+        "collage_id": collage_id,
+        "collage_url": f"/collage/{collage_id}",
+        "derivatives": derivatives,
+    }
+    if editable:
+        published["edit_url"] = f"/collage/{collage_id}/edit"
+    return published
+
+
 @app.post("/analyze-emotion")
 async def analyze_emotion(
     files: list[UploadFile] = File(...),
     theme: str = Form("magazine"),
-    user_prompt: str = Form("")
+    user_prompt: str = Form(""),
+    inline_image: bool = Form(True),
+    scale: float = Form(1.0, gt=0, le=1.0, description="0.25-0.5 for an instant preview, 1.0 for Ultra-HD"),
+    editable: bool = Form(False, description="Keep the render state for fast edits via POST /collage/{id}/edit")
 ):
-    print(f"--- STARTING STUDIO REQUEST [{theme}] with {len(files)} photos ---")
+    print(f"--- STARTING STUDIO REQUEST [{theme}] with {len(files)} photos at {scale:g}x ---")
 
+    analysis_task = None
+    speculative_task = None
     try:
-        # Read all uploaded files
-        photo_bytes_list = []
-        for file in files:
-            contents = await file.read()
-            photo_bytes_list.append(contents)
-            print(f"LOG: Photo {len(photo_bytes_list)} - {len(contents)} bytes")
+        photo_bytes_list, analysis_task = await _read_uploads(files, theme)
 
-        # STEP 1: Gemini analysis (with surgical fallback for rate limits)
-        first_image = Image.open(io.BytesIO(photo_bytes_list[0]))
-        prompt = f"""
-AS AN ELITE CREATIVE DIRECTOR:
-Analyze this image. Return STRICT JSON: {{ "dominantEmotion": "", "vibeDescription": "", "collageStyle": "{theme}", "emotions": [], "colorPalette": [] }}
-Theme: {theme}
-"""
-        try:
-            print("LOG: Requesting AI Analysis (Gemini)...")
-            response = model.generate_content([prompt, first_image])
-            # If AI is blocked, accessing .text will raise an exception
-            raw_text = response.text.replace("```json", "").replace("```", "").strip()
-            gemini_json = json.loads(raw_text)
-            print(f"LOG: AI Analysis Success -> {gemini_json.get('dominantEmotion', 'Unknown')}")
-        except Exception as ai_err:
-            print(f"WARNING: AI Studio Busy or Quota Limit Hit. Activating Artisanal Fallback.")
-            # We don't fail, we just use a premium pre-defined vibe
-            gemini_json = {
-                "dominantEmotion": "Timeless",
-                "vibeDescription": "A curated visual story by Mood Snap",
-                "collageStyle": theme if theme in ["scrapbook", "magazine", "moodboard", "filmstrip", "doodle"] else "magazine",
-                "emotions": ["Elegant", "Captured", "Artisanal"],
-                "colorPalette": ["#2D3436", "#636E72", "#B2BEC3", "#DFE6E9", "#FFFFFF"]
-            }
+        # STEP 2a: The theme usually decides the template, so decode, grade, cut out
+        # and compose the photos for it while the model is still answering. The canvas
+        # stays in that worker's layer cache, so the finishing render is sent there too
+        worker = uuid.uuid4().hex
+        speculative_task = asyncio.create_task(
+            render_pool.run(prepare_collage, photo_bytes_list, theme, scale, affinity=worker)
+        )
+        gemini_json = await analysis_task
 
-        # STEP 2: Create collage using the engine
+        # STEP 2b: Finish the prepared canvas if the analysis agrees on the template
+        prepared = await _reconcile_prepared(
+            speculative_task,
+            get_template_by_style(theme, len(photo_bytes_list), scale),
+            template_for_analysis(gemini_json, len(photo_bytes_list), scale)
+        )
         print(f"LOG: Starting Collage Creation for {len(photo_bytes_list)} photos...")
-        collage_bytes = create_collage_from_analysis(photo_bytes_list, gemini_json)
-        
-        # STEP 3: Encode collage to base64
-        collage_base64 = base64.b64encode(collage_bytes).decode()
+        # Seeded, so the returned spec re-renders this exact collage via POST /render
+        seed = random.randrange(2 ** 32)
+        spec = await asyncio.to_thread(spec_for_analysis, photo_bytes_list, gemini_json, scale, seed)
+        spec_hash = spec.spec_hash()
+        # Nothing prepared to pick up: any free worker will do (an editable collage still
+        # gets a key of its own, its edits go where its layers are cached)
+        affinity = worker if prepared is not None else (uuid.uuid4().hex if editable else None)
+        state = None
+        if editable:
+            collage, state = await render_pool.run(
+                render_editable_collage, photo_bytes_list, gemini_json, prepared, scale, seed, affinity=affinity
+            )
+            state.worker = affinity
+        else:
+            collage = await render_pool.run(
+                render_collage_from_analysis, photo_bytes_list, gemini_json, prepared, scale, None, seed,
+                affinity=affinity
+            )
+        published = await _publish_collage(collage, inline_image, state, spec_hash)
 
         print("--- REQUEST COMPLETE: COLLAGE GENERATED ---")
 
         return {
             "analysis": gemini_json,
-            "collage_image": f"data:image/png;base64,{collage_base64}",
+            **published,
+            "spec": spec.to_dict(),
+            "spec_hash": spec_hash,
+            "render_url": f"/render/{spec_hash}",
             "error": None
         }
 
+    except (RenderPoolSaturated, RenderPoolUnavailable) as e:
+        saturated = isinstance(e, RenderPoolSaturated)
+        print(f"WARNING: Studio at capacity, rejecting request: {e}")
+        return JSONResponse(
+            status_code=429 if saturated else 503,
+            headers={"Retry-After": str(render_pool.retry_after)},
+            content={
+                "analysis": None,
+                "collage_image": None,
+                "error": str(e)
+            }
+        )
+
     except Exception as e:
         print(f"❌ CRITICAL BACKEND ERROR: {e}")
         import traceback
@@ -134,3 +308,499 @@ Theme: {theme}
             "collage_image": None,
             "error": str(e)
         }
+
+    finally:
+        # Nothing started for this request outlives it
+        for task in (analysis_task, speculative_task):
+            if task is not None and not task.done():
+                task.cancel()
+
+
+# =========================
+# MULTI-THEME BATCH ENDPOINT
+# =========================
+BATCH_STYLES = ["scrapbook", "magazine", "moodboard", "filmstrip", "doodle", "sticker"]
+
+
+@app.post("/analyze-emotion/batch")
+async def analyze_emotion_batch(
+    files: list[UploadFile] = File(...),
+    theme: str = Form("magazine"),
+    user_prompt: str = Form(""),
+    styles: str = Form(",".join(BATCH_STYLES), description="Comma-separated styles to render"),
+    inline_image: bool = Form(False),
+    scale: float = Form(1.0, gt=0, le=1.0)
+):
+    """
+    Render one upload in several styles for side-by-side comparison. The photos
+    are read and analysed once, and every style renders in the same worker so
+    decoded, graded and cut-out photos are shared between templates.
+    """
+    style_list = list(dict.fromkeys(s.strip().lower() for s in styles.split(",") if s.strip()))
+    if not style_list:
+        return JSONResponse(status_code=400, content={"error": "No styles requested"})
+    print(f"--- STARTING BATCH STUDIO REQUEST [{theme}] {style_list} with {len(files)} photos at {scale:g}x ---")
+
+    analysis_task = None
+    try:
+        photo_bytes_list, analysis_task = await _read_uploads(files, theme)
+        gemini_json = await analysis_task
+
+        collages = await render_pool.run(
+            render_collages_from_analysis, photo_bytes_list, gemini_json, style_list, scale
+        )
+
+        # Styles sharing a template share one stored collage
+        published_by_image = {}
+        results = []
+        for style in style_list:
+            collage = collages[style]
+            if id(collage) not in published_by_image:
+                published_by_image[id(collage)] = await _publish_collage(collage, inline_image)
+            template = get_template_by_style(style, len(photo_bytes_list), scale)
+            results.append({"style": style, "template": template.name, **published_by_image[id(collage)]})
+
+        print(f"--- BATCH REQUEST COMPLETE: {len(published_by_image)} COLLAGES GENERATED ---")
+        return {
+            "analysis": gemini_json,
+            "collages": results,
+            "error": None
+        }
+
+    except (RenderPoolSaturated, RenderPoolUnavailable) as e:
+        saturated = isinstance(e, RenderPoolSaturated)
+        print(f"WARNING: Studio at capacity, rejecting request: {e}")
+        return JSONResponse(
+            status_code=429 if saturated else 503,
+            headers={"Retry-After": str(render_pool.retry_after)},
+            content={"analysis": None, "collages": [], "error": str(e)}
+        )
+
+    except Exception as e:
+        print(f"❌ CRITICAL BACKEND ERROR (batch): {e}")
+        import traceback
+        traceback.print_exc()
+        return {"analysis": None, "collages": [], "error": str(e)}
+
+    finally:
+        if analysis_task is not None and not analysis_task.done():
+            analysis_task.cancel()
+
+
+# =========================
+# STREAMING ENDPOINT (SSE)
+# =========================
+STREAM_PREVIEW_SCALE = float(os.getenv("STREAM_PREVIEW_SCALE", "0.25"))
+
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.post("/analyze-emotion/stream")
+async def analyze_emotion_stream(
+    files: list[UploadFile] = File(...),
+    theme: str = Form("magazine"),
+    user_prompt: str = Form(""),
+    inline_image: bool = Form(False),
+    scale: float = Form(1.0, gt=0, le=1.0)
+):
+    """
+    Same studio pipeline as /analyze-emotion, reported as Server-Sent Events:
+    analysis -> preview (a STREAM_PREVIEW_SCALE render) -> layer (per photo)
+    -> composite -> finish -> encode -> done, or a single error event.
+    Every event carries elapsed_ms since the request started.
+    """
+    print(f"--- STARTING STREAMING STUDIO REQUEST [{theme}] with {len(files)} photos at {scale:g}x ---")
+    started = time.monotonic()
+
+    # Uploads are read before the response starts (the form may be closed after
+    # that); a failure here is still reported as the stream's error event
+    photo_bytes_list, analysis_task, upload_error = [], None, None
+    try:
+        photo_bytes_list, analysis_task = await _read_uploads(files, theme)
+    except Exception as e:
+        upload_error = e
+
+    def event(name: str, **data) -> str:
+        data["elapsed_ms"] = round((time.monotonic() - started) * 1000)
+        return _sse(name, data)
+
+    async def events():
+        tasks = [analysis_task] if analysis_task is not None else []
+        try:
+            if upload_error is not None:
+                raise upload_error
+            yield event("uploaded", photos=len(photo_bytes_list))
+
+            gemini_json = await analysis_task
+            yield event("analysis", analysis=gemini_json)
+
+            # STEP 2: a quarter-size preview and the full render, queued in that order,
+            # so a free worker always picks up the cheap preview first
+            progress = await render_pool.progress_queue()
+            preview_task = None
+            if scale > STREAM_PREVIEW_SCALE:
+                preview_task = asyncio.create_task(render_pool.run(
+                    render_collage_from_analysis, photo_bytes_list, gemini_json, None, STREAM_PREVIEW_SCALE
+                ))
+                tasks.append(preview_task)
+            render_task = asyncio.create_task(render_pool.run(
+                render_collage_from_analysis, photo_bytes_list, gemini_json, None, scale, progress
+            ))
+            tasks.append(render_task)
+
+            pending = {t for t in (preview_task, render_task) if t is not None}
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=0.05, return_when=asyncio.FIRST_COMPLETED)
+                for update in await render_pool.drain(progress):
+                    yield event(update.pop("stage"), **update)
+                if preview_task in done:
+                    # The preview is a nicety: if it fails, keep waiting for the full render
+                    try:
+                        preview = preview_task.result()
+                        preview_jpeg = await collage_store.run(encode_image, preview, "jpeg", 80)
+                    except Exception as e:
+                        print(f"WARNING: Stream preview skipped: {e}")
+                        continue
+                    yield event(
+                        "preview", width=preview.width, height=preview.height,
+                        image=f"data:image/jpeg;base64,{base64.b64encode(preview_jpeg).decode()}"
+                    )
+
+            published = await _publish_collage(render_task.result(), inline_image)
+            yield event("encode", **{k: v for k, v in published.items() if k != "collage_image"})
+
+            print("--- STREAMING REQUEST COMPLETE: COLLAGE GENERATED ---")
+            yield event("done", analysis=gemini_json, **published, error=None)
+
+        except (RenderPoolSaturated, RenderPoolUnavailable) as e:
+            print(f"WARNING: Studio at capacity, rejecting request: {e}")
+            status = 429 if isinstance(e, RenderPoolSaturated) else 503
+            yield event("error", status=status, retry_after=render_pool.retry_after, error=str(e))
+
+        except Exception as e:
+            print(f"❌ CRITICAL BACKEND ERROR (stream): {e}")
+            import traceback
+            traceback.print_exc()
+            yield event("error", status=500, error=str(e))
+
+        finally:
+            # Client went away or we failed: nothing started for this request outlives it
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+# =========================
+# ASYNCHRONOUS JOB API
+# =========================
+JOB_MAX_QUEUED = int(os.getenv("JOB_MAX_QUEUED", "100"))
+
+
+async def _run_job(job: dict):
+    """Render one queued job; returns (analysis, result) for the job store"""
+    job_id = job["id"]
+    params = job["params"]
+    theme = params["theme"]
+    photo_bytes_list = await asyncio.to_thread(job_store.photos, job_id)
+
+    preview = await asyncio.to_thread(prepare_analysis_image, photo_bytes_list[0])
+    gemini_json = await analysis_service.analyze(preview, theme, build_prompt(theme))
+
+    while True:
+        try:
+            collage = await render_pool.run(
+                render_collage_from_analysis, photo_bytes_list, gemini_json, None, params["scale"]
+            )
+            break
+        except RenderPoolSaturated:
+            # Interactive requests filled the render queue; a job can afford to wait its turn
+            await asyncio.sleep(render_pool.retry_after)
+
+    # The PNG on disk outlives the in-memory collage store entry
+    png = await collage_store.run(encode_image, collage, "png")
+    saved = await asyncio.to_thread(job_store.save_result, job_id, lambda path: path.write_bytes(png))
+    if not saved:
+        # Cancelled while rendering; the job store drops this outcome
+        return gemini_json, None
+    # Only the file in the job directory: the collage store forgets a render
+    # long before the job store forgets the job
+    return gemini_json, {"result_url": f"/jobs/{job_id}/result"}
+
+
+job_runner = JobRunner(job_store, _run_job)
+
+
+@app.post("/jobs", status_code=202)
+async def create_job(
+    files: list[UploadFile] = File(...),
+    theme: str = Form("magazine"),
+    user_prompt: str = Form(""),
+    scale: float = Form(1.0, gt=0, le=1.0)
+):
+    """Queue a studio render and return immediately; poll GET /jobs/{id} for the result"""
+    if job_store.count(QUEUED) >= JOB_MAX_QUEUED:
+        return JSONResponse(
+            status_code=429,
+            headers={"Retry-After": str(render_pool.retry_after)},
+            content={"error": f"Job queue full ({JOB_MAX_QUEUED} waiting)"}
+        )
+
+    photo_bytes_list = [await file.read() for file in files]
+    job_id = await asyncio.to_thread(
+        job_store.create, photo_bytes_list, {"theme": theme, "user_prompt": user_prompt, "scale": scale}
+    )
+    job_runner.notify()
+    print(f"LOG: Queued job {job_id} [{theme}] with {len(photo_bytes_list)} photos")
+    return {"id": job_id, "status": QUEUED, "status_url": f"/jobs/{job_id}"}
+
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    job = job_store.get(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"error": "Job not found or expired"})
+    job["queue_position"] = job_store.queue_position(job_id)
+    return job
+
+
+@app.get("/jobs/{job_id}/result")
+def get_job_result(job_id: str):
+    job = job_store.get(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"error": "Job not found or expired"})
+    if job["status"] != DONE:
+        return JSONResponse(status_code=409, content={"error": f"Job is {job['status']}", "status": job["status"]})
+    return FileResponse(job_store.result_path(job_id), media_type="image/png")
+
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    job = await asyncio.to_thread(job_store.get, job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"error": "Job not found or expired"})
+    if job["status"] in FINISHED:
+        return JSONResponse(status_code=409, content={"error": f"Job already {job['status']}", "status": job["status"]})
+    status = await job_runner.cancel(job_id)
+    return {"id": job_id, "status": status}
+
+
+# =========================
+# BINARY COLLAGE DOWNLOAD
+# =========================
+def _encoder_busy(e: EncoderSaturated) -> JSONResponse:
+    print(f"WARNING: Encoders at capacity, rejecting download: {e}")
+    return JSONResponse(
+        status_code=429,
+        headers={"Retry-After": str(render_pool.retry_after)},
+        content={"error": str(e)}
+    )
+
+
+@app.get("/collage/{collage_id}")
+async def get_collage(
+    collage_id: str,
+    format: Optional[str] = Query(None, description="png, jpeg, webp or avif; overrides Accept"),
+    quality: Optional[int] = Query(None, ge=1, le=100, description="Snapped to the nearest COLLAGE_QUALITY_STEPS value"),
+    size: str = Query("full", description="full or a derivative name (thumb, social)"),
+    accept: Optional[str] = Header(None)
+):
+    fmt = negotiate_format(accept, format)
+    if fmt is None:
+        return JSONResponse(status_code=406, content={"error": "No acceptable image format"})
+
+    try:
+        data = await collage_store.download(collage_id, fmt, quality, size)
+    except EncoderSaturated as e:
+        return _encoder_busy(e)
+    if data is None:
+        sizes = collage_store.sizes(collage_id)
+        error = f"Unknown size '{size}', available: {sorted(sizes)}" if sizes else "Collage not found or expired"
+        return JSONResponse(status_code=404, content={"error": error})
+
+    return Response(
+        content=data,
+        media_type=OUTPUT_FORMATS[fmt][0],
+        headers={
+            "Cache-Control": f"private, max-age={int(collage_store.ttl)}",
+            "Vary": "Accept",
+        }
+    )
+
+
+# =========================
+# INCREMENTAL EDITS
+# =========================
+@app.post("/collage/{collage_id}/edit")
+async def edit_collage(
+    collage_id: str,
+    slot: Optional[int] = Form(None, ge=0, description="Photo slot (0-based) to replace with `file`"),
+    file: Optional[UploadFile] = File(None),
+    decorations: Optional[str] = Form(None, description='JSON {"<index>": {"content": "...", "color": "#RRGGBB"}} of decoration changes'),
+    inline_image: bool = Form(False)
+):
+    """
+    Re-render an editable collage after swapping one photo and/or changing
+    decorations (e.g. a caption). Only the changed layer is processed again; the
+    rest is re-composited from the layer cache of the render worker that holds the
+    collage (the uploads are only sent if it lost some of it). The edit is a new
+    collage (with its own edit_url); the original stays available.
+    """
+    state = collage_store.state(collage_id)
+    if state is None:
+        return JSONResponse(status_code=404, content={"error": "Collage not found, expired or not editable"})
+
+    photos = {}
+    if (slot is None) != (file is None):
+        return JSONResponse(status_code=400, content={"error": "Replacing a photo needs both slot and file"})
+    if file is not None:
+        photos[slot] = await file.read()
+
+    try:
+        changes = {int(index): dict(fields) for index, fields in json.loads(decorations).items()} if decorations else {}
+    except (ValueError, TypeError, AttributeError) as e:
+        return JSONResponse(status_code=400, content={"error": f"Invalid decorations: {e}"})
+    if not photos and not changes:
+        return JSONResponse(status_code=400, content={"error": "Nothing to edit"})
+
+    started = time.monotonic()
+    try:
+        try:
+            # Sent to the worker holding the collage's layers, so the uploads can stay here
+            collage, new_state = await render_pool.run(
+                rerender_collage, state.without_photos(), photos, changes, affinity=state.worker
+            )
+        except RenderStateMissing as e:
+            print(f"LOG: {e}, sending the uploads to rebuild it")
+            collage, new_state = await render_pool.run(
+                rerender_collage, state, photos, changes, affinity=state.worker
+            )
+        new_state = state.after_edit(new_state, photos)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    except (RenderPoolSaturated, RenderPoolUnavailable) as e:
+        saturated = isinstance(e, RenderPoolSaturated)
+        print(f"WARNING: Studio at capacity, rejecting edit: {e}")
+        return JSONResponse(
+            status_code=429 if saturated else 503,
+            headers={"Retry-After": str(render_pool.retry_after)},
+            content={"error": str(e)}
+        )
+
+    published = await _publish_collage(collage, inline_image, new_state)
+    render_ms = round((time.monotonic() - started) * 1000)
+    print(f"LOG: Edited collage {collage_id} -> {published['collage_id']} in {render_ms}ms")
+    return {**published, "edited_from": collage_id, "render_ms": render_ms, "error": None}
+
+
+# =========================
+# DETERMINISTIC RENDER FROM SPEC
+# =========================
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+
+@app.post("/render")
+async def render_collage_spec(
+    spec: str = Form(..., description="Render spec JSON, as returned in `spec` by /analyze-emotion"),
+    files: list[UploadFile] = File(...),
+    inline_image: bool = Form(False)
+):
+    """
+    Render a collage from an explicit spec - no Gemini call. The spec's template must
+    be a built-in layout (see validate_spec). Uploads are matched to the spec's photo
+    hashes (any order). Identical specs render identical bytes, so the result is
+    cached and served under the spec hash (ETag, GET /render/{hash}).
+    """
+    try:
+        render_spec = RenderSpec.from_dict(json.loads(spec))
+        validate_spec(render_spec)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    spec_hash = render_spec.spec_hash()
+    etag = f'"{spec_hash}"'
+
+    collage_id = collage_store.find(spec_hash)
+    cached = collage_id is not None
+    if cached:
+        print(f"LOG: Spec {spec_hash[:12]} already rendered as {collage_id}")
+        published = await _collage_fields(collage_id, inline_image)
+    else:
+        uploads = {}
+        for file in files:
+            contents = await file.read()
+            uploads[await asyncio.to_thread(photo_digest, contents)] = contents
+        missing = [h for h in render_spec.photo_hashes if h not in uploads]
+        if missing:
+            return JSONResponse(status_code=400, content={"error": "Photos missing for spec", "missing": missing})
+
+        print(f"--- RENDERING SPEC {spec_hash[:12]} [{render_spec.template.name}] ---")
+        try:
+            collage = await render_pool.run(
+                render_from_spec, render_spec, [uploads[h] for h in render_spec.photo_hashes]
+            )
+        except (RenderPoolSaturated, RenderPoolUnavailable) as e:
+            saturated = isinstance(e, RenderPoolSaturated)
+            print(f"WARNING: Studio at capacity, rejecting spec render: {e}")
+            return JSONResponse(
+                status_code=429 if saturated else 503,
+                headers={"Retry-After": str(render_pool.retry_after)},
+                content={"error": str(e)}
+            )
+        published = await _publish_collage(collage, inline_image, spec_hash=spec_hash)
+
+    return JSONResponse(
+        headers={"ETag": etag},
+        content={
+            **published,
+            "spec_hash": spec_hash,
+            "render_url": f"/render/{spec_hash}",
+            "cached": cached,
+            "error": None
+        }
+    )
+
+
+@app.get("/render/{spec_hash}")
+async def get_rendered_spec(
+    spec_hash: str,
+    format: Optional[str] = Query(None, description="png, jpeg, webp or avif; overrides Accept"),
+    quality: Optional[int] = Query(None, ge=1, le=100, description="Snapped to the nearest COLLAGE_QUALITY_STEPS value"),
+    size: str = Query("full", description="full or a derivative name (thumb, social)"),
+    accept: Optional[str] = Header(None),
+    if_none_match: Optional[str] = Header(None)
+):
+    """
+    A spec render as an image. The bytes depend only on the spec and these
+    parameters, so responses are publicly cacheable for good.
+    """
+    fmt = negotiate_format(accept, format)
+    if fmt is None:
+        return JSONResponse(status_code=406, content={"error": "No acceptable image format"})
+
+    quality = snap_quality(quality)
+    etag = f'"{spec_hash}-{size}-{fmt}{"" if fmt == "png" or quality is None else f"-q{quality}"}"'
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=31536000, immutable", "Vary": "Accept"}
+    if _etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+
+    collage_id = collage_store.find(spec_hash)
+    data = None
+    if collage_id is not None:
+        try:
+            data = await collage_store.download(collage_id, fmt, quality, size)
+        except EncoderSaturated as e:
+            return _encoder_busy(e)
+    if data is None:
+        return JSONResponse(status_code=404, content={"error": "Render not found or expired (POST /render again)"})
+    return Response(content=data, media_type=OUTPUT_FORMATS[fmt][0], headers=headers)
@@ -4,85 +4,433 @@ Orchestrates template selection, image processing, and final composition
 """
 
 import io
+import os
+import re
+import time
 import random
-from PIL import Image, ImageDraw, ImageFont
-from typing import List, Tuple
+import threading
+import dataclasses
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from PIL import Image, ImageColor, ImageDraw, ImageFont
+from typing import Any, Callable, Dict, List, Tuple, Optional
 import base64
 
 from collage_templates import get_template_by_style, CollageTemplate, PhotoPlacement
 from image_engine import (
-    apply_luxury_grade, apply_filter, add_polaroid_frame,
-    add_premium_shadow, add_studio_texture, rotate_image, create_gradient_background,
-    resize_to_fit, hex_to_rgb, create_cutout, apply_watercolor_effect,
-    add_washi_tape, add_hand_drawn_doodle, add_doodle_outline
+    grade_to_fit, apply_filter, add_polaroid_frame,
+    premium_shadow_layer, add_studio_texture, rotate_image, create_gradient,
+    resize_to_fit, hex_to_rgb, cutout_mask, cutout_masks, apply_watercolor_effect,
+    add_washi_tape, add_hand_drawn_doodle, add_doodle_outline, decode_image,
+    resolve_cutout_model, CUTOUT_MODELS, CUTOUT_SEGMENT_SIZE
 )
+from collage_output import encode_image
+from layer_cache import LayerCache, get_layer_cache, photo_digest, layer_key
+from render_spec import RenderSpec
+
+# Placement fields that only affect where a layer goes (and the shadow drawn under it),
+# not the pixels of the processed layer itself
+_POSITION_FIELDS = ("x", "y", "z_index", "no_shadow", "shadow_offset", "shadow_blur")
+
+# Decoration fields an edit may change (geometry and type stay as the template has them)
+EDITABLE_DECORATION_FIELDS = {"text": ("content", "color"), "doodle": ("color",), "washi_tape": ("color",)}
+MAX_CAPTION_LENGTH = 200
+# Most palette colors a render spec may carry
+MAX_PALETTE_COLORS = 16
+# Used when the analysis has no usable palette or emotion
+DEFAULT_PALETTE = ("#FFFFFF", "#000000")
+DEFAULT_EMOTION = "Joy"
+_HEX_COLOR = re.compile(r"^#[0-9A-Fa-f]{6}$")
+
+
+def _layer_params(placement: PhotoPlacement) -> tuple:
+    """Everything that changes the pixels of a processed layer"""
+    params = dataclasses.asdict(placement)
+    for name in _POSITION_FIELDS:
+        params.pop(name, None)
+    if params.get("use_cutout"):
+        params["cutout_quality"] = resolve_cutout_model(params.get("cutout_quality"))
+        params["segment_size"] = CUTOUT_SEGMENT_SIZE
+    return tuple(sorted(params.items()))
+
+
+def _default_photo_workers() -> int:
+    """
+    This process's share of the cores. Each process render worker gets
+    cores / RENDER_WORKERS, like the ONNX intra-op threads; in thread mode the one
+    pool below already serves every render.
+    """
+    cores = os.cpu_count() or 1
+    if os.getenv("RENDER_EXECUTOR", "process").lower() == "thread":
+        return cores
+    workers = int(os.getenv("RENDER_WORKERS", "0")) or cores
+    return max(1, cores // workers)
+
+
+# Photos of one collage are processed concurrently: decode, OpenCV grading and
+# ONNX segmentation all release the GIL
+PHOTO_WORKERS = int(os.getenv("PHOTO_WORKERS", "0")) or _default_photo_workers()
+
+_photo_pool: Optional[ThreadPoolExecutor] = None
+_photo_pool_lock = threading.Lock()
+
+
+def _get_photo_pool() -> ThreadPoolExecutor:
+    """Process-wide pool for per-photo layer work (shared by every engine in this worker)"""
+    global _photo_pool
+    if _photo_pool is None:
+        with _photo_pool_lock:
+            if _photo_pool is None:
+                _photo_pool = ThreadPoolExecutor(max_workers=PHOTO_WORKERS, thread_name_prefix="photo")
+    return _photo_pool
+
+
+@dataclasses.dataclass
+class PreparedCollage:
+    """
+    Background plus every photo layer, composed before the analysis is known.
+    Only a handle: the canvas stays in the render worker's layer cache, so it
+    never travels to the API process and back.
+    """
+    template: CollageTemplate
+    # Layer cache key of the composed canvas ("composite" stage)
+    key: str
+    # Per slot: whether its photo made it onto the canvas
+    placed: List[bool]
+
+
+class RenderStateMissing(Exception):
+    """An edit sent without its uploads needs a layer the worker no longer caches (send the full state)"""
+
+
+@dataclasses.dataclass
+class RenderState:
+    """
+    What a finished collage was built from, kept so a small edit re-renders only
+    what changed (CollageEngine.rerender). Only the inputs: the composite, layers
+    and shadows stay in the render worker's layer cache under keys derived from
+    them, and are rebuilt from the uploads wherever the cache misses.
+    """
+    template: CollageTemplate
+    # Per photo slot: the upload placed there, None if the photo failed.
+    # The whole list is None in a copy sent to the worker without them (without_photos)
+    photos: Optional[List[Optional[bytes]]]
+    # Per photo slot: digest of that upload, None if the photo failed
+    digests: List[Optional[str]]
+    palette: List[str]
+    emotion: str
+    # random.getstate() the doodles were drawn from, so a redraw matches stroke for stroke
+    decoration_random: tuple
+    # Render pool affinity key of the worker whose layer cache holds the buffers (set by the API)
+    worker: Optional[str] = None
+
+    def nbytes(self) -> int:
+        return sum(len(photo) for photo in self.photos or [] if photo is not None)
+
+    def without_photos(self) -> "RenderState":
+        """This state minus the uploads: enough for an edit while its worker still caches the layers"""
+        return dataclasses.replace(self, photos=None)
+
+    def after_edit(self, result: "RenderState", photos: Dict[int, bytes]) -> "RenderState":
+        """State `result` of an edit of this one (maybe sent without_photos), uploads and worker filled back in"""
+        uploads = [photos.get(slot, photo) for slot, photo in enumerate(self.photos)]
+        return dataclasses.replace(result, photos=uploads, worker=self.worker)
+
+
+def validate_decoration_changes(decorations: List[dict], changes: Dict[int, dict]):
+    """Raise ValueError unless `changes` only sets editable fields of existing decorations, with sane values"""
+    for index, fields in changes.items():
+        if not 0 <= index < len(decorations):
+            raise ValueError(f"No decoration {index} (template has {len(decorations)})")
+        dec_type = decorations[index].get("type")
+        allowed = EDITABLE_DECORATION_FIELDS.get(dec_type, ())
+        for field, value in fields.items():
+            if field not in allowed:
+                raise ValueError(f"Decoration {index} ({dec_type}) field '{field}' is not editable "
+                                 f"(editable: {', '.join(allowed) or 'none'})")
+            if field == "content" and (not isinstance(value, str) or len(value) > MAX_CAPTION_LENGTH):
+                raise ValueError(f"Caption must be a string of at most {MAX_CAPTION_LENGTH} characters")
+            if field == "color" and (not isinstance(value, str) or not _HEX_COLOR.match(value)):
+                raise ValueError(f"Color must be '#RRGGBB', got {value!r}")
+
+
+def _seeded_state(seed: Optional[int]) -> Optional[tuple]:
+    """Generator state doodles are drawn from for `seed` (None = the global generator)"""
+    return random.Random(seed).getstate() if seed is not None else None
+
+
+def template_for_analysis(analysis: dict, num_photos: int, scale: float = 1.0) -> CollageTemplate:
+    """The template create_collage_from_analysis will render for this analysis"""
+    return get_template_by_style(analysis.get("collageStyle", "moodboard"), num_photos, scale)
+
+
+def look_for_analysis(analysis: dict) -> Tuple[List[str], str]:
+    """
+    Palette and emotion a render uses for this analysis. The model answers free-form:
+    colors are normalised to '#RRGGBB' (CSS names and '#RGB' included, anything else
+    dropped, at most MAX_PALETTE_COLORS) and the emotion is made a string, so the
+    render and its spec agree and the spec passes validate_spec.
+    """
+    palette = []
+    colors = analysis.get("colorPalette")
+    for color in colors if isinstance(colors, list) else []:
+        try:
+            palette.append("#{:02X}{:02X}{:02X}".format(*ImageColor.getrgb(color)[:3]))
+        except (ValueError, TypeError, AttributeError):
+            continue
+    palette = palette[:MAX_PALETTE_COLORS] or list(DEFAULT_PALETTE)
+
+    emotion = analysis.get("dominantEmotion")
+    if isinstance(emotion, list):
+        emotion = next((e for e in emotion if isinstance(e, str)), None)
+    if not isinstance(emotion, str) or not emotion.strip():
+        emotion = DEFAULT_EMOTION
+    return palette, emotion.strip()
 
 
 class CollageEngine:
     """Main engine for creating professional collages"""
     
-    def __init__(self):
+    def __init__(self, cache: Optional[LayerCache] = None,
+                 progress: Optional[Callable[[Dict[str, Any]], None]] = None,
+                 keep_state: bool = False):
         self.canvas = None
         self.template = None
+        # Cache the pre-decoration composite and shadows, and keep the inputs for render_state()
+        self.keep_state = keep_state
+        # Per slot of the last composite: upload and digest, None where the photo failed
+        self.slot_photos: Optional[List[Optional[bytes]]] = None
+        self.slot_digests: Optional[List[Optional[str]]] = None
+        self.decoration_random: Optional[tuple] = None
+        self.palette: Optional[List[str]] = None
+        self.emotion: Optional[str] = None
+        # Content-addressed layer cache (process-wide unless one is passed in)
+        self.cache = cache if cache is not None else get_layer_cache()
+        # Optional stage listener, e.g. queue.put of a streaming request
+        self.progress = progress
+        self._stage_start = time.monotonic()
+        # photo digest -> decode size shared by all of its slots (set by create_collages)
+        self.decode_boxes: Dict[str, Tuple[int, int]] = {}
+        # cutout_alpha keys whose batched segmentation failed this render (no per-photo retry)
+        self._failed_cutouts = set()
+
+    def _report(self, stage: str, **details):
+        """Tell the progress listener a stage finished (never fails the render)"""
+        now = time.monotonic()
+        stage_ms = round((now - self._stage_start) * 1000)
+        self._stage_start = now
+        if self.progress is None:
+            return
+        try:
+            self.progress({"stage": stage, "stage_ms": stage_ms, **details})
+        except Exception as e:
+            print(f"WARNING: Progress listener failed: {e}")
         
     def create_collage(self, 
                       photo_bytes_list: List[bytes],
                       style: str,
                       color_palette: List[str],
-                      emotion: str) -> bytes:
+                      emotion: str,
+                      prepared: Optional[PreparedCollage] = None,
+                      scale: float = 1.0) -> bytes:
+        """
+        Main method to create a complete collage (ULTRA-HD PNG bytes)
+        `scale` < 1 renders the same layout smaller, e.g. 0.25 for a quick preview.
+        """
+        collage = self.render_canvas(photo_bytes_list, style, color_palette, emotion, prepared, scale)
+
+        # 8. ULTRA-HD Export with maximum quality
+        print("LOG: Exporting ULTRA-HD collage (PNG with maximum quality)...")
+        return encode_image(collage, "png")
+
+    def render_spec(self, spec: RenderSpec, photo_bytes_list: List[bytes]) -> Image.Image:
+        """
+        Deterministic render of a RenderSpec, no analysis involved: its template,
+        palette and seeded doodles. `photo_bytes_list` is in the spec's slot order.
+        """
+        self.compose_layers(photo_bytes_list, spec.template.name, spec.template.scale, template=spec.template)
+        return self.finish_canvas(spec.palette, spec.emotion, _seeded_state(spec.seed))
+
+    def create_collages(self,
+                        photo_bytes_list: List[bytes],
+                        styles: List[str],
+                        color_palette: List[str],
+                        emotion: str,
+                        scale: float = 1.0) -> Dict[str, Image.Image]:
+        """
+        Render the same photos in several styles: {style: finished RGB collage}.
+        Styles that select the same template are rendered once. Each photo is
+        decoded once, large enough for every slot it lands in, and the layer cache
+        shares grading and cutouts wherever two templates give a photo the same
+        slot size and look.
+        """
+        num_photos = len(photo_bytes_list)
+        templates: List[CollageTemplate] = []
+        style_template = {}
+        for style in styles:
+            template = get_template_by_style(style, num_photos, scale)
+            if template not in templates:
+                templates.append(template)
+            else:
+                print(f"LOG: Style '{style}' uses the '{template.name}' template already queued")
+            style_template[style] = templates.index(template)
+
+        # One decode box per photo covering its slot in every template
+        for i, photo_bytes in enumerate(photo_bytes_list):
+            slots = [t.placements[i] for t in templates if i < len(t.placements)]
+            if slots:
+                box = (max(p.width for p in slots), max(p.height for p in slots))
+                self.decode_boxes[photo_digest(photo_bytes)] = box
+
+        rendered = []
+        try:
+            for n, template in enumerate(templates):
+                style = next(s for s, idx in style_template.items() if idx == n)
+                print(f"LOG: Rendering style '{style}' ({n+1}/{len(templates)} templates)...")
+                rendered.append(self.render_canvas(photo_bytes_list, style, color_palette, emotion, scale=scale))
+        finally:
+            self.decode_boxes.clear()
+        return {style: rendered[idx] for style, idx in style_template.items()}
+
+    def render_canvas(self,
+                      photo_bytes_list: List[bytes],
+                      style: str,
+                      color_palette: List[str],
+                      emotion: str,
+                      prepared: Optional[PreparedCollage] = None,
+                      scale: float = 1.0,
+                      seed: Optional[int] = None) -> Image.Image:
         """
-        Main method to create a complete collage
+        Render the collage as an RGB image, leaving the encoding to the caller.
+        `prepared` (from compose_layers for the same photos) skips straight to the
+        palette-dependent finishing steps when its template is the one selected.
+        """
+        template = get_template_by_style(style, len(photo_bytes_list), scale)
+        composite = None
+        if prepared is not None and prepared.template == template:
+            composite = self.cache.get("composite", prepared.key)
+            if composite is None:
+                # Evicted, or the worker that prepared it was restarted (or not sent this render)
+                print(f"LOG: Prepared '{template.name}' layers not in this worker's cache, composing again")
+        elif prepared is not None:
+            print(f"LOG: Discarding prepared '{prepared.template.name}' layers, analysis picked '{template.name}'")
+
+        if composite is not None:
+            print(f"LOG: Using speculatively prepared '{template.name}' layers")
+            self.template = prepared.template
+            # Cached images are shared: draw on a copy (finish_canvas makes one itself when keeping state)
+            self.canvas = composite if self.keep_state else composite.copy()
+            self._keep_slots(photo_bytes_list, prepared.placed)
+            self._report("composite", layers=len(template.placements), template=template.name, prepared=True)
+        else:
+            self.compose_layers(photo_bytes_list, style, scale)
+        return self.finish_canvas(color_palette, emotion, _seeded_state(seed))
+
+    def compose_layers(self, photo_bytes_list: List[bytes], style: str, scale: float = 1.0,
+                       template: Optional[CollageTemplate] = None) -> Image.Image:
+        """
+        Steps 1-5: background plus every processed photo, in z order.
+        None of it depends on the palette or emotion, so it can run while the
+        analysis is still in flight. An explicit `template` overrides the style lookup.
         """
         num_photos = len(photo_bytes_list)
         
         # 1. Select appropriate template
-        self.template = get_template_by_style(style, num_photos)
+        self.template = template or get_template_by_style(style, num_photos, scale)
         
         # 2. Create canvas with background
         self.canvas = self._create_background()
         self.canvas = self.canvas.convert("RGBA")
         
-        # 3. Process each photo first (collect in a list for sorting)
-        layers = []
+        # 3. Process every photo concurrently (collect by slot for sorting)
         total_photos = len(photo_bytes_list)
         available_slots = len(self.template.placements)
         
         print(f"LOG: Engine received {total_photos} photos. Selected template '{self.template.name}' has {available_slots} slots.")
-        
-        for i, photo_bytes in enumerate(photo_bytes_list):
-            if i >= available_slots:
-                print(f"LOG: Skipping photo {i+1} (No more slots in template)")
-                break
-            
+        if total_photos > available_slots:
+            print(f"LOG: Skipping photos {available_slots+1}-{total_photos} (No more slots in template)")
+
+        jobs = list(zip(photo_bytes_list, self.template.placements))
+        digests = [photo_digest(photo_bytes) for photo_bytes, _ in jobs]
+        processed = [None] * len(jobs)
+        pool = _get_photo_pool()
+        futures = {}
+
+        def submit(i):
             print(f"LOG: Processing Photo {i+1}/{total_photos}...")
-            placement = self.template.placements[i]
+            photo_bytes, placement = jobs[i]
+            futures[pool.submit(self._process_photo, photo_bytes, placement, digests[i])] = i
+
+        self._failed_cutouts = set()
+        # Plain photos start right away; cutouts wait for one batched segmentation
+        cutouts = [i for i, (_, placement) in enumerate(jobs) if getattr(placement, "use_cutout", False)]
+        for i in range(len(jobs)):
+            if i not in cutouts:
+                submit(i)
+        self._batch_cutouts([(jobs[i][0], digests[i], jobs[i][1]) for i in cutouts])
+        for i in cutouts:
+            submit(i)
+
+        for future in as_completed(futures):
+            i = futures[future]
             try:
-                processed_photo = self._process_photo(photo_bytes, placement)
-                layers.append((processed_photo, placement))
+                processed[i] = future.result()
                 print(f"LOG: Photo {i+1} layer created successfully.")
+                self._report("layer", index=i, total=len(jobs), ok=True)
             except Exception as e:
+                # One bad photo only loses its own slot
                 print(f"ERROR: Failed photo {i+1} processing: {e}")
+                self._report("layer", index=i, total=len(jobs), ok=False, error=str(e))
+
+        # Slot order first, so equal z_index layers stack exactly as before
+        layers = [(i, layer, placement) for i, (layer, (_, placement)) in enumerate(zip(processed, jobs))
+                  if layer is not None]
         
+        stats = self.cache.stats()
+        print(f"LOG: Layer cache {stats['memory_mb']}MB in memory, stages: {stats['stages']}")
+
         # 4. Sort layers by z_index
         print(f"LOG: Sorting {len(layers)} layers for composition...")
-        layers.sort(key=lambda x: getattr(x[1], 'z_index', 0))
+        layers.sort(key=lambda x: getattr(x[2], 'z_index', 0))
         
         # 5. Place sorted layers
-        for idx, (photo, placement) in enumerate(layers):
+        for idx, (slot, photo, placement) in enumerate(layers):
             print(f"LOG: Pasting layer {idx+1}/{len(layers)} onto canvas...")
-            self._place_photo(photo, placement)
-        
+            key = self._layer_key(digests[slot], placement) if self.keep_state else None
+            self._place_photo(photo, placement, key)
+        self._keep_slots([photo_bytes for photo_bytes, _ in jobs], [layer is not None for layer in processed], digests)
+
+        self._report("composite", layers=len(layers), template=self.template.name)
+        return self.canvas
+
+    def finish_canvas(self, color_palette: List[str], emotion: str,
+                      decoration_random: Optional[tuple] = None) -> Image.Image:
+        """
+        Steps 6-7: palette-dependent decorations and texture; returns the flattened RGB collage.
+        `decoration_random` (a random.getstate()) fixes the doodle jitter, e.g. to
+        redraw an earlier render or to render a seeded spec.
+        """
+        if decoration_random is None and self.keep_state:
+            decoration_random = random.getstate()
+        rng = None
+        if decoration_random is not None:
+            rng = random.Random()
+            rng.setstate(decoration_random)
+        if self.keep_state:
+            # The composite is cached untouched for later edits; decorations go onto a copy
+            key = self._composite_key(self.slot_digests)
+            if not self.cache.contains(key):
+                self.cache.put("composite", key, self.canvas)
+            self.canvas = self.canvas.copy()
+            self.decoration_random = decoration_random
+            self.palette, self.emotion = color_palette, emotion
+
         # 6. Add decorative elements (stickers, doodles)
-        self._add_decorations(color_palette, emotion)
+        self._add_decorations(color_palette, emotion, rng)
         
         # 7. Final Studio Polish (HD Texture)
         print("LOG: Applying final Studio Polish (Paper/Film Texture)...")
         self.canvas = add_studio_texture(self.canvas)
 
-        # 8. ULTRA-HD Export with maximum quality
-        print("LOG: Exporting ULTRA-HD collage (PNG with maximum quality)...")
-        output = io.BytesIO()
-
         # Convert to RGB for final export if needed (preserves quality)
         if self.canvas.mode == 'RGBA':
             # Create white background for transparency
@@ -92,36 +440,144 @@ class CollageEngine:
         else:
             export_canvas = self.canvas.convert('RGB')
 
-        # Maximum quality PNG export
-        # compress_level=1 (fast but larger file, better quality than optimize=True)
-        export_canvas.save(output, format='PNG', compress_level=1)
-
         print(f"LOG: Final collage size: {export_canvas.size}, Mode: {export_canvas.mode}")
-        return output.getvalue()
+        self._report("finish", width=export_canvas.width, height=export_canvas.height)
+        return export_canvas
     
+    def render_state(self) -> RenderState:
+        """State of the last render of a keep_state engine, for rerender()"""
+        if not self.keep_state or self.decoration_random is None:
+            raise RuntimeError("No render state kept (create the engine with keep_state=True)")
+        return RenderState(
+            template=self.template,
+            photos=list(self.slot_photos),
+            digests=list(self.slot_digests),
+            palette=self.palette,
+            emotion=self.emotion,
+            decoration_random=self.decoration_random,
+        )
+
+    def rerender(self, state: RenderState,
+                 photos: Optional[Dict[int, bytes]] = None,
+                 decorations: Optional[Dict[int, dict]] = None) -> Image.Image:
+        """
+        Re-render a kept collage after a small edit, redoing only what changed.
+        - photos: slot -> new upload. Only those layers are processed; every other
+          layer and shadow comes from the layer cache, then the canvas is re-composited
+        - decorations: decoration index -> changed fields, a caption's "content" or
+          any decoration's "color" (validate_decoration_changes). Without photo
+          changes the cached composite is reused as is
+        Decorations, texture and flattening always run again (they sit on top of
+        everything). Whatever the cache no longer holds (evicted, or another
+        render worker built it) is rebuilt from the uploads in the state; a state
+        sent without_photos raises RenderStateMissing instead.
+        The engine keeps the new state for the next edit.
+        Raises ValueError for a slot or decoration the template does not have, or a
+        field an edit may not change.
+        """
+        photos = photos or {}
+        decorations = decorations or {}
+        template = state.template
+        for slot in photos:
+            if not 0 <= slot < len(state.digests):
+                raise ValueError(f"No photo slot {slot} (collage has {len(state.digests)})")
+        validate_decoration_changes(template.decorations, decorations)
+        if decorations:
+            template = dataclasses.replace(template, decorations=[
+                {**decoration, **decorations.get(i, {})} for i, decoration in enumerate(template.decorations)
+            ])
+
+        self.keep_state = True
+        self.template = template
+        self._stage_start = time.monotonic()
+
+        slot_photos = list(state.photos) if state.photos is not None else [None] * len(state.digests)
+        digests = list(state.digests)
+        for slot, photo_bytes in photos.items():
+            slot_photos[slot] = photo_bytes
+            digests[slot] = photo_digest(photo_bytes)
+        self._keep_slots(slot_photos, [digest is not None for digest in digests], digests)
+
+        composite = self.cache.get("composite", self._composite_key(digests))
+        if composite is not None:
+            print("LOG: Re-rendering decorations over the cached composite")
+            self.canvas = composite
+            return self.finish_canvas(state.palette, state.emotion, state.decoration_random)
+
+        # Same stacking as compose_layers: slot order, then a stable sort by z_index.
+        # Unchanged layers and their shadows are layer cache hits
+        self.canvas = self._create_background().convert("RGBA")
+        order = sorted((i for i, digest in enumerate(digests) if digest is not None),
+                       key=lambda i: getattr(template.placements[i], "z_index", 0))
+        for i in order:
+            placement = template.placements[i]
+            if i in photos:
+                print(f"LOG: Re-processing photo slot {i+1}...")
+            if slot_photos[i] is None:
+                layer = self.cache.get("layer", self._layer_key(digests[i], placement))
+                if layer is None:
+                    raise RenderStateMissing(f"Layer of photo slot {i+1} is no longer cached")
+            else:
+                layer = self._process_photo(slot_photos[i], placement, digests[i])
+            if i in photos:
+                self._report("layer", index=i, total=len(slot_photos), ok=True)
+            self._place_photo(layer, placement, self._layer_key(digests[i], placement))
+        self._report("composite", layers=len(order), template=template.name, changed=sorted(photos))
+        return self.finish_canvas(state.palette, state.emotion, state.decoration_random)
+
+    def _keep_slots(self, photo_bytes_list: List[bytes], placed: List[bool],
+                    digests: Optional[List[str]] = None):
+        """Remember which upload sits in which slot of the current composite"""
+        digests = digests or [photo_digest(photo_bytes) for photo_bytes in photo_bytes_list[:len(placed)]]
+        self.slot_photos = [photo if ok else None for photo, ok in zip(photo_bytes_list, placed)]
+        self.slot_digests = [digest if ok else None for digest, ok in zip(digests, placed)]
+
+    def _composite_key(self, digests: List[Optional[str]]) -> str:
+        """Cache key of the background plus these photos' layers (None = empty slot) on self.template"""
+        layers = [self._layer_key(digest, placement) if digest is not None else "-"
+                  for digest, placement in zip(digests, self.template.placements)]
+        geometry = dataclasses.replace(self.template, decorations=[])
+        return layer_key("composite", ",".join(layers), repr(geometry))
+
     def _create_background(self) -> Image.Image:
         """Create the canvas background"""
         width = self.template.canvas_width
         height = self.template.canvas_height
         
         if self.template.background_type == "gradient":
-            color1 = hex_to_rgb(self.template.background_colors[0])
-            color2 = hex_to_rgb(self.template.background_colors[1] if len(self.template.background_colors) > 1 else self.template.background_colors[0])
-            return create_gradient_background(width, height, color1, color2)
+            colors = [hex_to_rgb(c) for c in self.template.background_colors]
+            return create_gradient(width, height, colors, self.template.gradient_direction)
         else:
             color = hex_to_rgb(self.template.background_colors[0])
             return Image.new("RGB", (width, height), color)
     
-    def _process_photo(self, photo_bytes: bytes, placement: PhotoPlacement) -> Image.Image:
-        """Process a single photo with expert effects"""
-        # 1. Background removal optimization (only if template suggests it)
+    def _process_photo(self, photo_bytes: bytes, placement: PhotoPlacement,
+                       digest: Optional[str] = None) -> Image.Image:
+        """Process a single photo with expert effects (cached by photo content + look)"""
+        digest = digest or photo_digest(photo_bytes)
+        key = self._layer_key(digest, placement)
+
+        layer = self.cache.get("layer", key)
+        if layer is not None:
+            print("LOG: Reusing cached layer for this photo and look")
+            return layer
+
+        layer = self._build_layer(photo_bytes, digest, placement)
+        self.cache.put("layer", key, layer)
+        return layer
+
+    def _build_layer(self, photo_bytes: bytes, digest: str, placement: PhotoPlacement) -> Image.Image:
+        """Run the full photo pipeline, reusing any cached intermediate stage"""
+        # 0. Decode once at (roughly) slot resolution, EXIF orientation applied
+        slot = (placement.width, placement.height)
+        source = self._decoded(photo_bytes, digest, slot)
+
+        # 1-2. Fit to the slot FIRST, so every later filter runs at output resolution
+        # Cutouts are segmented at low resolution and come back fitted to the slot
         if getattr(placement, "use_cutout", False):
-            img = create_cutout(photo_bytes)
+            img = self._cutout(source, digest, placement)
         else:
-            img = apply_luxury_grade(photo_bytes)
-            
-        # 2. Resize
-        img = resize_to_fit(img, placement.width, placement.height)
+            img = self._graded(source, digest, slot)
         
         # 3. Artistic filters
         if placement.filter == "watercolor":
@@ -143,14 +599,99 @@ class CollageEngine:
             # For quality, we apply outline after resizing but before shadow
             img = add_doodle_outline(img, placement.outline_width, placement.outline_color)
 
-        # 7. Premium Shadow
-        if not getattr(placement, "no_shadow", False):
-            img = add_premium_shadow(img)
-        
+        # 7. Premium Shadow is drawn straight onto the canvas in _place_photo
         return img
+
+    def _graded(self, source: Image.Image, digest: str, slot: Tuple[int, int]) -> Image.Image:
+        return self.cache.get_or_create(
+            "graded", layer_key("graded", digest, self._source_params(digest, slot, slot)),
+            lambda: grade_to_fit(source, *slot)
+        )
+
+    def _decoded(self, photo_bytes: bytes, digest: str, slot: Tuple[int, int]) -> Image.Image:
+        box = self.decode_boxes.get(digest, slot)
+        return self.cache.get_or_create(
+            "decoded", layer_key("decoded", digest, box),
+            lambda: decode_image(photo_bytes, target_size=box)
+        )
+
+    def _layer_key(self, digest: str, placement: PhotoPlacement) -> str:
+        return layer_key("layer", digest, self._source_params(digest, _layer_params(placement), placement))
+
+    def _source_params(self, digest: str, params: Any, slot) -> Any:
+        """
+        Cache params of a stage built from the decoded photo. A photo decoded larger
+        than its slot (decode_boxes) yields slightly different pixels, so it is keyed apart.
+        """
+        if isinstance(slot, PhotoPlacement):
+            slot = (slot.width, slot.height)
+        box = self.decode_boxes.get(digest, slot)
+        return params if box == slot else (params, ("decode_box", box))
+
+    def _cutout_key(self, digest: str, placement: PhotoPlacement) -> str:
+        slot = (placement.width, placement.height)
+        model_name = resolve_cutout_model(placement.cutout_quality)
+        params = self._source_params(digest, (slot, model_name, CUTOUT_SEGMENT_SIZE), slot)
+        return layer_key("cutout_alpha", digest, params)
+
+    def _batch_cutouts(self, cutouts: List[Tuple[bytes, str, PhotoPlacement]]):
+        """
+        Segment every cutout of this collage that is not cached yet in one batched
+        inference per model, seeding the cutout_alpha cache before the per-photo
+        workers ask for it. A single pending cutout is left to its worker.
+        """
+        by_model: Dict[str, list] = {}
+        for photo_bytes, digest, placement in cutouts:
+            key = self._cutout_key(digest, placement)
+            if self.cache.contains(self._layer_key(digest, placement)) or self.cache.contains(key):
+                continue
+            model_name = resolve_cutout_model(placement.cutout_quality)
+            by_model.setdefault(model_name, []).append((photo_bytes, digest, placement, key))
+
+        pool = _get_photo_pool()
+        for model_name, pending in by_model.items():
+            if len(pending) < 2:
+                continue
+            try:
+                start = time.monotonic()
+                sources = list(pool.map(
+                    lambda item: self._decoded(item[0], item[1], (item[2].width, item[2].height)), pending
+                ))
+                fitteds = [resize_to_fit(source, p[2].width, p[2].height) for source, p in zip(sources, pending)]
+                alphas = cutout_masks(list(zip(sources, fitteds)), model_name)
+                for (_, _, _, key), alpha in zip(pending, alphas):
+                    self.cache.put("cutout_alpha", key, alpha)
+                print(f"LOG: Segmented {len(pending)} cutouts with '{model_name}' in one batch "
+                      f"({time.monotonic() - start:.2f}s)")
+            except Exception as e:
+                print(f"WARNING: Background removal skipped/failed: {e}")
+                self._failed_cutouts.update(key for _, _, _, key in pending)
+
+    def _cutout(self, source: Image.Image, digest: str, placement: PhotoPlacement) -> Image.Image:
+        """Background-removed photo fitted to its slot; only the alpha is cached"""
+        slot = (placement.width, placement.height)
+        key = self._cutout_key(digest, placement)
+        fitted = resize_to_fit(source, *slot)
+        try:
+            if key in self._failed_cutouts:
+                raise RuntimeError("batched segmentation failed for this render")
+            print("LOG: Attempting Background Removal (this may take a moment)...")
+            alpha = self.cache.get_or_create(
+                "cutout_alpha", key,
+                lambda: cutout_mask(source, fitted, placement.cutout_quality)
+            )
+        except Exception as e:
+            print(f"WARNING: Background removal skipped/failed: {e}")
+            # Fallback: Just used the luxury graded image
+            return self._graded(source, digest, slot).convert("RGBA")
+        fitted.putalpha(alpha)
+        return fitted
     
-    def _place_photo(self, photo: Image.Image, placement: PhotoPlacement):
-        """Place processed photo on canvas using alpha composition"""
+    def _place_photo(self, photo: Image.Image, placement: PhotoPlacement, key: Optional[str] = None):
+        """
+        Place processed photo (and its premium shadow) on canvas using alpha composition.
+        With the photo's layer `key` the shadow goes through the layer cache too.
+        """
         final_x = placement.x
         final_y = placement.y
         
@@ -159,16 +700,44 @@ class CollageEngine:
         # Expert Fix: Ensure RGBA for transparency support
         if photo.mode != 'RGBA':
             photo = photo.convert('RGBA')
-            
-        # Create temp layer
-        layer = Image.new("RGBA", self.canvas.size, (0, 0, 0, 0))
-        layer.paste(photo, (final_x, final_y), photo)
-        
-        # Merge with main canvas
-        self.canvas = Image.alpha_composite(self.canvas, layer)
+
+        # 7. Premium Shadow: rendered into the canvas, the photo sits inside its padding
+        if not getattr(placement, "no_shadow", False):
+            offset = (placement.shadow_offset, placement.shadow_offset)
+            make_shadow = lambda: premium_shadow_layer(photo.split()[3], offset, placement.shadow_blur)
+            if key is not None:
+                shadow = self.cache.get_or_create(
+                    "shadow", layer_key("shadow", key, (offset, placement.shadow_blur)), make_shadow
+                )
+            else:
+                shadow = make_shadow()
+            self._composite_layer(shadow, final_x, final_y)
+            final_x += placement.shadow_blur * 2
+            final_y += placement.shadow_blur * 2
+
+        self._composite_layer(photo, final_x, final_y)
+
+    def _composite_layer(self, photo: Image.Image, final_x: int, final_y: int):
+        """Alpha-composite an RGBA layer whose top-left corner lands at (final_x, final_y)"""
+        # Clip to the canvas: only the rectangle the photo covers is touched
+        left = max(final_x, 0)
+        top = max(final_y, 0)
+        right = min(final_x + photo.width, self.canvas.width)
+        bottom = min(final_y + photo.height, self.canvas.height)
+        if right <= left or bottom <= top:
+            print("LOG: Photo lies outside the canvas, skipping")
+            return
+        visible = photo.crop((left - final_x, top - final_y, right - final_x, bottom - final_y))
+
+        # Create temp layer (same self-masked paste as before, at layer size)
+        layer = Image.new("RGBA", visible.size, (0, 0, 0, 0))
+        layer.paste(visible, (0, 0), visible)
+
+        # Merge with main canvas in place
+        self.canvas.alpha_composite(layer, dest=(left, top))
     
-    def _add_decorations(self, color_palette: List[str], emotion: str):
-        """Add expert decorations"""
+    def _add_decorations(self, color_palette: List[str], emotion: str, rng: Optional[random.Random] = None):
+        """Add expert decorations (doodle jitter from `rng` when given)"""
         for decoration in self.template.decorations:
             dec_type = decoration.get("type")
             color = color_palette[0] if color_palette else "#000000"
@@ -179,8 +748,10 @@ class CollageEngine:
                     decoration.get("shape", "heart"),
                     decoration["x"], 
                     decoration["y"], 
-                    decoration.get("size", 60),
-                    decoration.get("color", color)
+                    decoration.get("size", max(1, round(60 * self.template.scale))),
+                    decoration.get("color", color),
+                    self.template.scale,
+                    rng
                 )
             elif dec_type == "washi_tape":
                 add_washi_tape(
@@ -188,7 +759,8 @@ class CollageEngine:
                     decoration["x"],
                     decoration["y"],
                     decoration.get("rotation", 0),
-                    decoration.get("color", color)
+                    decoration.get("color", color),
+                    self.template.scale
                 )
             elif dec_type == "text":
                 self._draw_text(decoration)
@@ -198,13 +770,15 @@ class CollageEngine:
         draw = ImageDraw.Draw(self.canvas)
         try:
             # We try for a serif or handwritten font if available
-            font = ImageFont.truetype("arialbi.ttf", decoration.get("font_size", 40))
+            font = ImageFont.truetype("arialbi.ttf", decoration.get("font_size", max(1, round(40 * self.template.scale))))
         except:
-            font = ImageFont.load_default()
+            # Pillow's bundled 10px font, kept proportional when rendering below Ultra-HD
+            font = ImageFont.load_default(size=max(1, round(10 * self.template.scale)))
         
         # Add slight shadow to text
+        shadow = max(1, round(2 * self.template.scale))
         draw.text(
-            (decoration["x"]+2, decoration["y"]+2),
+            (decoration["x"]+shadow, decoration["y"]+shadow),
             decoration["content"],
             fill=(0, 0, 0, 100),
             font=font
@@ -217,9 +791,131 @@ class CollageEngine:
         )
 
 
-def create_collage_from_analysis(photos: List[bytes], analysis: dict) -> bytes:
+def prepare_collage(photos: List[bytes], style: str, scale: float = 1.0) -> PreparedCollage:
+    """
+    Speculative first half of a render for the style the client asked for. The
+    canvas goes to this worker's layer cache; the returned handle finds it there.
+    """
+    engine = CollageEngine()
+    canvas = engine.compose_layers(photos, style, scale)
+    key = engine._composite_key(engine.slot_digests)
+    engine.cache.put("composite", key, canvas)
+    return PreparedCollage(template=engine.template, key=key,
+                           placed=[digest is not None for digest in engine.slot_digests])
+
+
+def create_collage_from_analysis(photos: List[bytes], analysis: dict,
+                                 prepared: Optional[PreparedCollage] = None,
+                                 scale: float = 1.0) -> bytes:
+    engine = CollageEngine()
+    style = analysis.get("collageStyle", "moodboard")
+    palette, emotion = look_for_analysis(analysis)
+    return engine.create_collage(photos, style, palette, emotion, prepared, scale)
+
+
+def render_collage_from_analysis(photos: List[bytes], analysis: dict,
+                                 prepared: Optional[PreparedCollage] = None,
+                                 scale: float = 1.0, progress_queue=None,
+                                 seed: Optional[int] = None) -> Image.Image:
+    """
+    Like create_collage_from_analysis, but returns the RGB image for the output store to encode.
+    Stage events are put on `progress_queue` (a queue usable from the render worker).
+    With `seed` the render is reproducible from spec_for_analysis(..., seed).
+    """
+    engine = CollageEngine(progress=progress_queue.put if progress_queue is not None else None)
+    style = analysis.get("collageStyle", "moodboard")
+    palette, emotion = look_for_analysis(analysis)
+    return engine.render_canvas(photos, style, palette, emotion, prepared, scale, seed)
+
+
+def render_collages_from_analysis(photos: List[bytes], analysis: dict, styles: List[str],
+                                  scale: float = 1.0) -> Dict[str, Image.Image]:
+    """One analysis, several styles: {style: RGB image} from CollageEngine.create_collages"""
     engine = CollageEngine()
+    palette, emotion = look_for_analysis(analysis)
+    return engine.create_collages(photos, styles, palette, emotion, scale)
+
+
+def render_editable_collage(photos: List[bytes], analysis: dict,
+                            prepared: Optional[PreparedCollage] = None,
+                            scale: float = 1.0,
+                            seed: Optional[int] = None) -> Tuple[Image.Image, RenderState]:
+    """render_collage_from_analysis that also returns the RenderState for later edits"""
+    engine = CollageEngine(keep_state=True)
     style = analysis.get("collageStyle", "moodboard")
-    palette = analysis.get("colorPalette", ["#FFFFFF", "#000000"])
-    emotion = analysis.get("dominantEmotion", "Joy")
-    return engine.create_collage(photos, style, palette, emotion)
+    palette, emotion = look_for_analysis(analysis)
+    collage = engine.render_canvas(photos, style, palette, emotion, prepared, scale, seed)
+    return collage, engine.render_state()
+
+
+def rerender_collage(state: RenderState, photos: Optional[Dict[int, bytes]] = None,
+                     decorations: Optional[Dict[int, dict]] = None) -> Tuple[Image.Image, RenderState]:
+    """
+    CollageEngine.rerender for the render pool; returns the collage and its new state
+    (without uploads if `state` came without_photos: RenderState.after_edit restores them)
+    """
+    engine = CollageEngine()
+    collage = engine.rerender(state, photos, decorations)
+    new_state = engine.render_state()
+    return collage, (new_state if state.photos is not None else new_state.without_photos())
+
+
+def spec_for_analysis(photos: List[bytes], analysis: dict, scale: float, seed: int) -> RenderSpec:
+    """The RenderSpec that reproduces render_collage_from_analysis(photos, analysis, scale=scale, seed=seed)"""
+    template = template_for_analysis(analysis, len(photos), scale)
+    palette, emotion = look_for_analysis(analysis)
+    # Pin the cutout model, so a later change of the server default cannot change this spec's pixels
+    template = dataclasses.replace(template, placements=[
+        dataclasses.replace(p, cutout_quality=resolve_cutout_model(p.cutout_quality)) if p.use_cutout else p
+        for p in template.placements
+    ])
+    return RenderSpec(
+        template=template,
+        palette=palette,
+        emotion=emotion,
+        seed=seed,
+        photo_hashes=[photo_digest(photo) for photo in photos[:len(template.placements)]],
+    )
+
+
+def validate_spec(spec: RenderSpec):
+    """
+    Raise ValueError unless `spec` describes a render this server would produce:
+    its template must be the built-in layout for its name, slot count and scale,
+    differing at most in the pinned cutout model and editable decoration fields.
+    """
+    template = spec.template
+    if not 0 < template.scale <= 1:
+        raise ValueError(f"Render spec scale must be in (0, 1], got {template.scale}")
+    if not spec.palette or len(spec.palette) > MAX_PALETTE_COLORS:
+        raise ValueError(f"Render spec palette must have 1-{MAX_PALETTE_COLORS} colors")
+    for color in spec.palette:
+        if not _HEX_COLOR.match(color):
+            raise ValueError(f"Palette color must be '#RRGGBB', got {color!r}")
+
+    expected = get_template_by_style(template.name, len(template.placements), template.scale)
+    if len(expected.placements) != len(template.placements) or len(expected.decorations) != len(template.decorations):
+        raise ValueError(f"Render spec template '{template.name}' is not a built-in layout")
+
+    placements = []
+    for placement, built_in in zip(template.placements, expected.placements):
+        quality = placement.cutout_quality
+        if quality is not None and quality not in CUTOUT_MODELS and quality not in CUTOUT_MODELS.values():
+            raise ValueError(f"Unknown cutout model {quality!r}")
+        placements.append(dataclasses.replace(placement, cutout_quality=built_in.cutout_quality))
+
+    changes = {}
+    for index, (decoration, built_in) in enumerate(zip(template.decorations, expected.decorations)):
+        if decoration.keys() != built_in.keys():
+            raise ValueError(f"Render spec decoration {index} does not match the '{template.name}' template")
+        changes[index] = {key: value for key, value in decoration.items() if value != built_in[key]}
+    validate_decoration_changes(expected.decorations, changes)
+
+    if dataclasses.replace(template, placements=placements, decorations=expected.decorations) != expected:
+        raise ValueError(f"Render spec template '{template.name}' does not match the built-in layout at "
+                         f"{template.scale:g}x")
+
+
+def render_from_spec(spec: RenderSpec, photos: List[bytes]) -> Image.Image:
+    """CollageEngine.render_spec for the render pool (photos in the spec's slot order)"""
+    return CollageEngine().render_spec(spec, photos)
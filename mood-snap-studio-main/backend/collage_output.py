@@ -0,0 +1,357 @@
+"""
+Collage Output
+Keeps rendered collages for binary download and encodes them in the format the client accepts
+"""
+
+import io
+import os
+import asyncio
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from PIL import Image, features
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# format -> (mime type, Pillow format name)
+OUTPUT_FORMATS = {
+    "png": ("image/png", "PNG"),
+    "jpeg": ("image/jpeg", "JPEG"),
+    "webp": ("image/webp", "WEBP"),
+    "avif": ("image/avif", "AVIF"),
+}
+
+DEFAULT_QUALITY = {
+    "jpeg": int(os.getenv("COLLAGE_JPEG_QUALITY", "92")),
+    "webp": int(os.getenv("COLLAGE_WEBP_QUALITY", "90")),
+    "avif": int(os.getenv("COLLAGE_AVIF_QUALITY", "80")),
+}
+
+DEFAULT_FORMAT = os.getenv("COLLAGE_DEFAULT_FORMAT", "png").lower()
+
+# Qualities actually encoded: a requested ?quality= snaps to the nearest one, so
+# downloads asking for 83 or 85 share one cached encoding instead of adding another
+QUALITY_STEPS = sorted({int(q) for q in os.getenv("COLLAGE_QUALITY_STEPS", "50,65,80,90,100").split(",") if q.strip()})
+
+
+def snap_quality(quality: Optional[int]) -> Optional[int]:
+    """Nearest QUALITY_STEPS entry (ties go up); None keeps the format default"""
+    if quality is None:
+        return None
+    return min(QUALITY_STEPS, key=lambda step: (abs(step - quality), -step))
+
+
+def available_formats() -> List[str]:
+    """Output formats this Pillow build can encode (WebP/AVIF depend on the build)"""
+    formats = ["png", "jpeg"]
+    if features.check("webp"):
+        formats.append("webp")
+    if features.check("avif"):
+        formats.append("avif")
+    return formats
+
+
+def negotiate_format(accept: Optional[str], requested: Optional[str] = None) -> Optional[str]:
+    """
+    Pick the output format: an explicit `requested` format wins, otherwise the
+    highest-q image type in the Accept header that we can encode.
+    Wildcards (image/*, */*) and a missing header mean DEFAULT_FORMAT.
+    Returns None when nothing acceptable can be produced (HTTP 406).
+    """
+    formats = available_formats()
+    default = DEFAULT_FORMAT if DEFAULT_FORMAT in formats else "png"
+
+    if requested:
+        requested = requested.lower()
+        requested = "jpeg" if requested == "jpg" else requested
+        return requested if requested in formats else None
+
+    if not accept:
+        return default
+
+    candidates = []
+    for position, item in enumerate(accept.split(",")):
+        parts = [p.strip() for p in item.split(";")]
+        media_type = parts[0].lower()
+        q = 1.0
+        for param in parts[1:]:
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        if q <= 0 or not media_type:
+            continue
+        candidates.append((-q, position, media_type))
+
+    for _, _, media_type in sorted(candidates):
+        if media_type in ("*/*", "image/*"):
+            return default
+        for fmt in formats:
+            if OUTPUT_FORMATS[fmt][0] == media_type:
+                return fmt
+    return None
+
+
+def encode_image(img: Image.Image, fmt: str, quality: Optional[int] = None) -> bytes:
+    """Encode an RGB collage; `quality` is ignored for PNG (always lossless)"""
+    if quality is None:
+        quality = DEFAULT_QUALITY.get(fmt)
+
+    output = io.BytesIO()
+    if fmt == "png":
+        # compress_level=1 (fast but larger file, better quality than optimize=True)
+        img.save(output, format="PNG", compress_level=1)
+    elif fmt == "jpeg":
+        # 4:4:4 keeps thin doodle lines and text crisp
+        img.save(output, format="JPEG", quality=quality, subsampling=0, progressive=True)
+    elif fmt == "webp":
+        img.save(output, format="WEBP", quality=quality, method=4)
+    elif fmt == "avif":
+        img.save(output, format="AVIF", quality=quality, speed=8)
+    else:
+        raise ValueError(f"Unsupported output format: {fmt}")
+    return output.getvalue()
+
+
+def _parse_derivatives(spec: str) -> Dict[str, int]:
+    """"thumb:360,social:1080" -> {"thumb": 360, "social": 1080}"""
+    sizes = {}
+    for item in spec.split(","):
+        if ":" in item:
+            name, width = item.split(":", 1)
+            sizes[name.strip()] = int(width)
+    return sizes
+
+
+# Named output widths rendered next to the full-size collage
+DERIVATIVE_WIDTHS = _parse_derivatives(os.getenv("COLLAGE_DERIVATIVES", "thumb:360,social:1080"))
+# Derivatives encoded as soon as a collage is stored; everything else is encoded on first request
+PREFETCH_SIZES = [s.strip() for s in os.getenv("COLLAGE_PREFETCH", "thumb,social").split(",") if s.strip()]
+
+
+def build_derivatives(img: Image.Image, widths: Optional[Dict[str, int]] = None) -> Dict[str, Image.Image]:
+    """
+    Resolution pyramid of one composed canvas: "full" plus each named width.
+    Levels are produced largest-first, each downscaled from the previous one,
+    so small sizes never touch the full-resolution pixels.
+    """
+    widths = DERIVATIVE_WIDTHS if widths is None else widths
+    derivatives = {"full": img}
+    source = img
+    for name, width in sorted(widths.items(), key=lambda item: -item[1]):
+        if width >= source.width:
+            derivatives[name] = source
+            continue
+        height = max(1, round(source.height * width / source.width))
+        # reducing_gap: cheap box reduction first, Lanczos for the last <2x step
+        source = source.resize((width, height), Image.Resampling.LANCZOS, reducing_gap=2.0)
+        derivatives[name] = source
+    return derivatives
+
+
+def _call_soon(loop: asyncio.AbstractEventLoop, callback: Callable[[], Any]):
+    """Run `callback` on `loop` from an encoder thread (no-op once the loop is closed)"""
+    try:
+        loop.call_soon_threadsafe(callback)
+    except RuntimeError:
+        pass
+
+
+class EncoderSaturated(Exception):
+    """Every encoder thread is busy and the wait queue is full (maps to HTTP 429)"""
+
+
+class CollageStore:
+    """
+    Rendered collages by id, for GET /collage/{id}.
+    LRU bounded by decoded pixel bytes (COLLAGE_STORE_MB) with a TTL
+    (COLLAGE_STORE_TTL). Each collage keeps its derivative pyramid and every
+    encoding produced so far, so repeat downloads are free. Editable collages
+    also keep the render state an edit starts from (counted in the budget).
+    A collage stored under a content key (a render spec hash) can be found by it.
+
+    Methods are synchronous; from the event loop, run the expensive ones (put,
+    encoded, encode_image) with `await store.run(...)`: that puts them on the
+    store's COLLAGE_ENCODE_THREADS encoder threads, never the loop's default
+    executor. Up to COLLAGE_ENCODE_QUEUE more calls wait for a thread; download()
+    raises EncoderSaturated beyond that.
+
+    The store lives in this process's memory: with several uvicorn workers a
+    collage is only found by the worker that rendered it (the others answer 404).
+    Run a single API worker - renders already scale out through RENDER_WORKERS -
+    or pin each client to one worker.
+    """
+
+    def __init__(self, max_bytes: Optional[int] = None, ttl: Optional[float] = None,
+                 encode_threads: Optional[int] = None):
+        if max_bytes is None:
+            max_bytes = int(os.getenv("COLLAGE_STORE_MB", "512")) * 1024 * 1024
+        self.max_bytes = max_bytes
+        self.ttl = ttl if ttl is not None else float(os.getenv("COLLAGE_STORE_TTL", "900"))
+        self.encode_threads = encode_threads or int(os.getenv("COLLAGE_ENCODE_THREADS", "4"))
+        self.encode_queue = int(os.getenv("COLLAGE_ENCODE_QUEUE", str(self.encode_threads * 2)))
+        # Pillow encoders release the GIL, so derivatives really encode in parallel
+        self._encoder = ThreadPoolExecutor(max_workers=self.encode_threads, thread_name_prefix="collage-encode")
+        # Calls submitted to the encoder threads and not finished yet (only touched on the event loop)
+        self._pending = 0
+        self.encode_rejected = 0
+
+        # id -> [expires_at, derivatives {size: image}, encodings {(size, fmt, quality): bytes}, nbytes,
+        #        render state, content key]
+        self._entries: "OrderedDict[str, list]" = OrderedDict()
+        self._by_key: Dict[str, str] = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def put(self, img: Image.Image, state=None, key: Optional[str] = None) -> str:
+        """Store a collage (optionally with the RenderState it can be edited from and a content key)"""
+        derivatives = build_derivatives(img)
+        collage_id = uuid.uuid4().hex
+        # A size at or above the canvas width shares the full image, count it once
+        unique = {id(d): d for d in derivatives.values()}.values()
+        nbytes = sum(d.width * d.height * len(d.getbands()) for d in unique)
+        if state is not None:
+            nbytes += state.nbytes()
+        with self._lock:
+            self._entries[collage_id] = [time.monotonic() + self.ttl, derivatives, {}, nbytes, state, key]
+            self._bytes += nbytes
+            if key is not None:
+                self._by_key[key] = collage_id
+            self._evict()
+        return collage_id
+
+    def get(self, collage_id: str, size: str = "full") -> Optional[Image.Image]:
+        with self._lock:
+            entry = self._live_entry(collage_id)
+            return entry[1].get(size) if entry is not None else None
+
+    def find(self, key: str) -> Optional[str]:
+        """Id of the live collage stored under content `key` (None if there is none)"""
+        with self._lock:
+            collage_id = self._by_key.get(key)
+            if collage_id is None or self._live_entry(collage_id) is None:
+                return None
+            return collage_id
+
+    def state(self, collage_id: str):
+        """Render state of an editable collage (None if unknown, expired or not editable)"""
+        with self._lock:
+            entry = self._live_entry(collage_id)
+            return entry[4] if entry is not None else None
+
+    def sizes(self, collage_id: str) -> Dict[str, Tuple[int, int]]:
+        """Available derivatives of a stored collage and their pixel sizes"""
+        with self._lock:
+            entry = self._live_entry(collage_id)
+            if entry is None:
+                return {}
+            return {name: img.size for name, img in entry[1].items()}
+
+    def encoded(self, collage_id: str, fmt: str, quality: Optional[int] = None,
+                size: str = "full") -> Optional[bytes]:
+        """Encoded bytes of a stored collage derivative (None if unknown or expired)"""
+        quality = None if fmt == "png" else snap_quality(quality)
+        key = (size, fmt, quality)
+        with self._lock:
+            entry = self._live_entry(collage_id)
+            if entry is None or size not in entry[1]:
+                return None
+            img, encodings = entry[1][size], entry[2]
+            data = encodings.get(key)
+        if data is not None:
+            return data
+
+        # Encode outside the lock; two racing downloads at worst encode twice
+        data = encode_image(img, fmt, quality)
+        with self._lock:
+            entry = self._entries.get(collage_id)
+            if entry is not None and key not in entry[2]:
+                entry[2][key] = data
+                entry[3] += len(data)
+                self._bytes += len(data)
+                self._evict()
+        return data
+
+    def prefetch(self, collage_id: str, fmt: Optional[str] = None):
+        """
+        Start encoding the PREFETCH_SIZES derivatives in the background (call on the
+        event loop). Skipped while downloads already keep every encoder thread busy;
+        those sizes then encode on first request.
+        """
+        fmt = fmt or (DEFAULT_FORMAT if DEFAULT_FORMAT in available_formats() else "png")
+        for size in PREFETCH_SIZES:
+            if self._pending >= self.encode_threads:
+                return
+            self._submit(self.encoded, collage_id, fmt, None, size)
+
+    async def run(self, fn: Callable[..., Any], *args) -> Any:
+        """`fn(*args)` on an encoder thread, waiting for one however long the queue (for output a render needs)"""
+        return await asyncio.wrap_future(self._submit(fn, *args))
+
+    async def download(self, collage_id: str, fmt: str, quality: Optional[int] = None,
+                       size: str = "full") -> Optional[bytes]:
+        """
+        encoded() for a download request. A cached encoding is returned right away;
+        otherwise the encode queues for an encoder thread, or raises EncoderSaturated
+        when encode_threads + encode_queue calls are already in.
+        """
+        data = self.cached(collage_id, fmt, quality, size)
+        if data is not None:
+            return data
+        if self._pending >= self.encode_threads + self.encode_queue:
+            self.encode_rejected += 1
+            raise EncoderSaturated(f"Encoder queue full ({self._pending} encodes running or waiting)")
+        return await self.run(self.encoded, collage_id, fmt, quality, size)
+
+    def cached(self, collage_id: str, fmt: str, quality: Optional[int] = None,
+               size: str = "full") -> Optional[bytes]:
+        """An encoding produced earlier, or None (cheap enough for the event loop)"""
+        quality = None if fmt == "png" else snap_quality(quality)
+        with self._lock:
+            entry = self._live_entry(collage_id)
+            return entry[2].get((size, fmt, quality)) if entry is not None else None
+
+    def _submit(self, fn: Callable[..., Any], *args) -> Future:
+        """Submit to the encoder threads, counted in _pending until the call finishes (event loop only)"""
+        loop = asyncio.get_running_loop()
+        future = self._encoder.submit(fn, *args)
+        self._pending += 1
+        future.add_done_callback(lambda _: _call_soon(loop, self._finished))
+        return future
+
+    def _finished(self):
+        self._pending -= 1
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "memory_mb": round(self._bytes / (1024 * 1024), 1),
+                "memory_limit_mb": round(self.max_bytes / (1024 * 1024), 1),
+                "ttl_seconds": self.ttl,
+                "encodes": self._pending,
+                "encode_rejected": self.encode_rejected,
+            }
+
+    def _live_entry(self, collage_id: str) -> Optional[list]:
+        entry = self._entries.get(collage_id)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            self._drop(collage_id)
+            return None
+        self._entries.move_to_end(collage_id)
+        return entry
+
+    def _drop(self, collage_id: str):
+        entry = self._entries.pop(collage_id)
+        self._bytes -= entry[3]
+        if entry[5] is not None and self._by_key.get(entry[5]) == collage_id:
+            del self._by_key[entry[5]]
+
+    def _evict(self):
+        # Always keep the newest entry, even if it alone exceeds the budget
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            self._drop(next(iter(self._entries)))
@@ -3,8 +3,8 @@ Collage Template Definitions
 Pinterest-inspired layouts with precise positioning and styling
 """
 
-from typing import List, Dict, Tuple, Any
-from dataclasses import dataclass
+from typing import List, Dict, Tuple, Any, Optional
+from dataclasses import dataclass, replace, asdict, fields
 
 
 @dataclass
@@ -19,10 +19,13 @@ class PhotoPlacement:
     filter: str = "none" # none, luxury, vintage, bw, vibrant, soft, watercolor
     z_index: int = 0
     use_cutout: bool = False # Use background removal
+    cutout_quality: Optional[str] = None # draft, fast, standard, high (None = server default)
     use_outline: bool = False # Use doodle outline
     outline_width: int = 20
     outline_color: str = "#FFFFFF"
     no_shadow: bool = False
+    shadow_offset: int = 20 # px, drop shadow offset down and right
+    shadow_blur: int = 40 # px, the shadow pads the photo by twice this
 
 
 @dataclass
@@ -32,9 +35,65 @@ class CollageTemplate:
     canvas_width: int
     canvas_height: int
     background_type: str  # solid, gradient, texture
-    background_colors: List[str]  # Hex colors
+    background_colors: List[str]  # Hex colors (gradients use every color as a stop)
     placements: List[PhotoPlacement]
     decorations: List[Dict[str, Any]]  # Stickers, text, etc.
+    gradient_direction: str = "vertical"  # vertical, horizontal, radial
+    scale: float = 1.0  # 1.0 = Ultra-HD; see scale_template
+
+
+# Pixel-valued decoration keys that follow the template scale
+_DECORATION_POSITION_KEYS = ("x", "y")
+_DECORATION_SIZE_KEYS = ("size", "font_size")
+
+
+def _scaled(value: float, scale: float) -> int:
+    """Scaled size, never below 1px"""
+    return max(1, int(round(value * scale)))
+
+
+def _scale_decoration(decoration: Dict[str, Any], scale: float) -> Dict[str, Any]:
+    scaled = dict(decoration)
+    for key in _DECORATION_POSITION_KEYS:
+        if key in scaled:
+            scaled[key] = int(round(scaled[key] * scale))
+    for key in _DECORATION_SIZE_KEYS:
+        if key in scaled:
+            scaled[key] = _scaled(scaled[key], scale)
+    return scaled
+
+
+def scale_template(template: CollageTemplate, scale: float) -> CollageTemplate:
+    """
+    Proportionally identical copy of `template` at `scale` (e.g. 0.25 for an
+    instant preview): canvas, slots, outline widths, shadows and decorations
+    all shrink together, so every pixel-based effect downstream gets cheaper.
+    """
+    if scale == 1.0:
+        return template
+
+    placements = [
+        replace(
+            p,
+            x=int(round(p.x * scale)),
+            y=int(round(p.y * scale)),
+            width=_scaled(p.width, scale),
+            height=_scaled(p.height, scale),
+            outline_width=_scaled(p.outline_width, scale),
+            shadow_offset=int(round(p.shadow_offset * scale)),
+            shadow_blur=_scaled(p.shadow_blur, scale),
+        )
+        for p in template.placements
+    ]
+    decorations = [_scale_decoration(d, scale) for d in template.decorations]
+    return replace(
+        template,
+        canvas_width=_scaled(template.canvas_width, scale),
+        canvas_height=_scaled(template.canvas_height, scale),
+        placements=placements,
+        decorations=decorations,
+        scale=template.scale * scale,
+    )
 
 
 # ============================================================================
@@ -292,10 +351,54 @@ def get_sticker_collage_template(num_photos: int) -> CollageTemplate:
 # ============================================================================
 # TEMPLATE SELECTOR
 # ============================================================================
-def get_template_by_style(style: str, num_photos: int) -> CollageTemplate:
+def template_to_dict(template: CollageTemplate) -> Dict[str, Any]:
+    """JSON-ready form of a template (placements and decorations included)"""
+    return asdict(template)
+
+
+# JSON types accepted for each scalar field type (bool is an int subclass, so it is never a number here)
+_JSON_TYPES = {
+    int: ((int,), "an integer"),
+    float: ((int, float), "a number"),
+    str: ((str,), "a string"),
+    bool: ((bool,), "true or false"),
+    Optional[str]: ((str, type(None)), "a string or null"),
+}
+
+
+def _checked_fields(cls, data: Dict[str, Any]) -> Dict[str, Any]:
+    """`data` as keyword arguments for `cls`; raises TypeError if a scalar field has the wrong JSON type"""
+    values = dict(data)
+    for field in fields(cls):
+        if field.type not in _JSON_TYPES or field.name not in values:
+            continue
+        allowed, expected = _JSON_TYPES[field.type]
+        value = values[field.name]
+        if not isinstance(value, allowed) or (isinstance(value, bool) and bool not in allowed):
+            raise TypeError(f"{cls.__name__}.{field.name} must be {expected}, got {value!r}")
+    return values
+
+
+def template_from_dict(data: Dict[str, Any]) -> CollageTemplate:
+    """Inverse of template_to_dict; raises TypeError/KeyError for unknown, missing or mistyped fields"""
+    values = _checked_fields(CollageTemplate, data)
+    if not all(isinstance(color, str) for color in values["background_colors"]):
+        raise TypeError("CollageTemplate.background_colors must be a list of strings")
+    values["background_colors"] = list(values["background_colors"])
+    values["placements"] = [PhotoPlacement(**_checked_fields(PhotoPlacement, p)) for p in values["placements"]]
+    values["decorations"] = [dict(d) for d in values["decorations"]]
+    return CollageTemplate(**values)
+
+
+def get_template_by_style(style: str, num_photos: int, scale: float = 1.0) -> CollageTemplate:
     """
-    Select appropriate template based on detected style/emotion
+    Select appropriate template based on detected style/emotion,
+    rendered at `scale` of its Ultra-HD size
     """
+    return scale_template(_template_for_style(style, num_photos), scale)
+
+
+def _template_for_style(style: str, num_photos: int) -> CollageTemplate:
     style = style.lower()
     
     if "sticker" in style or "cutout" in style or "scrapbook" in style or "memory" in style:
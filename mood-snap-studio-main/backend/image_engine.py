@@ -1,27 +1,243 @@
+import os
 import cv2
 import numpy as np
 import io
 import random
-from PIL import Image, ImageEnhance, ImageFilter, ImageDraw, ImageFont, ImageChops
-from typing import Tuple, Optional
-from rembg import remove
+import threading
+from PIL import Image, ImageEnhance, ImageFilter, ImageDraw, ImageFont, ImageChops, ImageOps
+from typing import List, Tuple, Optional, Iterable, Union
+from rembg import remove, new_session
+
+
+# Background removal models by quality tier (fastest -> finest edges)
+CUTOUT_MODELS = {
+    "draft": "u2netp",
+    "fast": "silueta",
+    "standard": "u2net",
+    "high": "isnet-general-use",
+}
+DEFAULT_CUTOUT_QUALITY = os.getenv("CUTOUT_QUALITY", "standard")
+# Longest side fed to the segmentation model (0 = full resolution)
+CUTOUT_SEGMENT_SIZE = int(os.getenv("CUTOUT_SEGMENT_SIZE", "1024"))
+# Most images segmented by one batched ONNX run
+CUTOUT_BATCH_SIZE = int(os.getenv("CUTOUT_BATCH_SIZE", "8"))
+
+# Input normalisation of each rembg model: (mean, std, network input size).
+# Copied from the sessions' predict(); test_segment_batch.py checks they still agree
+_SEGMENT_INPUTS = {
+    "u2netp": ((0.485, 0.456, 0.406), (0.229, 0.224, 0.225), (320, 320)),
+    "silueta": ((0.485, 0.456, 0.406), (0.229, 0.224, 0.225), (320, 320)),
+    "u2net": ((0.485, 0.456, 0.406), (0.229, 0.224, 0.225), (320, 320)),
+    "isnet-general-use": ((0.5, 0.5, 0.5), (1.0, 1.0, 1.0), (1024, 1024)),
+}
+
+_rembg_sessions = {}
+_rembg_warmed = set()
+_rembg_unbatched = set()  # models whose graph has a fixed batch size
+_rembg_lock = threading.Lock()
+
+
+def resolve_cutout_model(quality: Optional[str] = None) -> str:
+    """Map a quality tier (or a raw rembg model name) to a model name"""
+    quality = quality or DEFAULT_CUTOUT_QUALITY
+    if quality in CUTOUT_MODELS:
+        return CUTOUT_MODELS[quality]
+    if quality in CUTOUT_MODELS.values():
+        return quality
+    print(f"WARNING: Unknown cutout quality '{quality}', using standard")
+    return CUTOUT_MODELS["standard"]
+
+
+def _onnx_session_options():
+    """
+    Explicit ONNX Runtime threading instead of the library default
+    (every session grabbing every core, which oversubscribes render workers).
+    """
+    import onnxruntime as ort
+
+    # Split the cores between render workers unless told otherwise
+    workers = int(os.getenv("RENDER_WORKERS", "0")) or os.cpu_count() or 1
+    default_intra = max(1, (os.cpu_count() or 1) // workers)
+
+    opts = ort.SessionOptions()
+    opts.intra_op_num_threads = int(os.getenv("ONNX_INTRA_OP_THREADS", str(default_intra)))
+    opts.inter_op_num_threads = int(os.getenv("ONNX_INTER_OP_THREADS", "1"))
+    opts.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    return opts
+
+
+def get_rembg_session(model_name: str):
+    """
+    Process-wide rembg session cache.
+    Sessions are created lazily once per model and reused by every cutout.
+    """
+    session = _rembg_sessions.get(model_name)
+    if session is None:
+        with _rembg_lock:
+            session = _rembg_sessions.get(model_name)
+            if session is None:
+                print(f"LOG: Loading background removal model '{model_name}'...")
+                session = new_session(model_name, sess_opts=_onnx_session_options())
+                _rembg_sessions[model_name] = session
+    return session
+
+
+def warm_up_rembg(qualities: Optional[Iterable[str]] = None):
+    """
+    Load the configured models and run one tiny inference each, so the first
+    real request does not pay for model load and ONNX graph initialisation.
+    """
+    if qualities is None:
+        qualities = os.getenv("CUTOUT_WARMUP", DEFAULT_CUTOUT_QUALITY).split(",")
+
+    for quality in qualities:
+        if not quality.strip():
+            continue
+        model_name = resolve_cutout_model(quality.strip())
+        if model_name in _rembg_warmed:
+            continue
+        try:
+            session = get_rembg_session(model_name)
+            remove(Image.new("RGB", (64, 64), (128, 128, 128)), session=session)
+            _rembg_warmed.add(model_name)
+            print(f"LOG: Background removal model '{model_name}' warmed up")
+        except Exception as e:
+            print(f"WARNING: Could not warm up '{model_name}': {e}")
+
+
+def guided_upsample_mask(mask: Image.Image, guide: Image.Image, radius: int = 8, eps: float = 1e-3) -> Image.Image:
+    """
+    Edge-aware mask upscaling (fast guided filter).
+    The linear coefficients are solved at the mask's low resolution against a
+    downscaled guide, then upsampled and applied to the full-resolution guide,
+    so the alpha edge snaps to real image edges instead of blurry bilinear steps.
+    """
+    low_w, low_h = mask.size
+    guide_gray = guide.convert("L")
+
+    I_low = np.asarray(guide_gray.resize((low_w, low_h), Image.Resampling.BILINEAR), dtype=np.float32) / 255.0
+    p_low = np.asarray(mask, dtype=np.float32) / 255.0
+    ksize = (radius * 2 + 1, radius * 2 + 1)
+
+    mean_I = cv2.boxFilter(I_low, -1, ksize)
+    mean_p = cv2.boxFilter(p_low, -1, ksize)
+    cov_Ip = cv2.boxFilter(I_low * p_low, -1, ksize) - mean_I * mean_p
+    var_I = cv2.boxFilter(I_low * I_low, -1, ksize) - mean_I * mean_I
+
+    a = cov_Ip / (var_I + eps)
+    b = mean_p - a * mean_I
+    mean_a = cv2.boxFilter(a, -1, ksize)
+    mean_b = cv2.boxFilter(b, -1, ksize)
+
+    # Upsample only the smooth coefficients, then apply them at full resolution
+    I_high = np.asarray(guide_gray, dtype=np.float32) / 255.0
+    size = guide_gray.size
+    A = cv2.resize(mean_a, size, interpolation=cv2.INTER_LINEAR)
+    B = cv2.resize(mean_b, size, interpolation=cv2.INTER_LINEAR)
+    q = A * I_high + B
+
+    return Image.fromarray(np.uint8(np.clip(q * 255.0 + 0.5, 0, 255)), mode="L")
+
+
+def segment_batch(images: List[Image.Image], quality: Optional[str] = None) -> List[Image.Image]:
+    """
+    Foreground masks for several images, one ONNX run per CUTOUT_BATCH_SIZE images.
+    Every input is resized to the network's square input and normalised exactly
+    as rembg does for a single image, so each mask (returned at its image's size)
+    matches remove(..., only_mask=True). Models that cannot take a batch are run
+    one image at a time. Raises if background removal is unavailable.
+    """
+    model_name = resolve_cutout_model(quality)
+    session = get_rembg_session(model_name)
+    spec = _SEGMENT_INPUTS.get(model_name)
+
+    if spec is None or len(images) < 2 or model_name in _rembg_unbatched:
+        return [remove(img, session=session, only_mask=True) for img in images]
+
+    masks = []
+    for start in range(0, len(images), CUTOUT_BATCH_SIZE):
+        chunk = images[start:start + CUTOUT_BATCH_SIZE]
+        try:
+            masks.extend(_run_segment_batch(session, chunk, *spec))
+        except Exception as e:
+            print(f"WARNING: Batched segmentation unavailable for '{model_name}', segmenting one by one: {e}")
+            _rembg_unbatched.add(model_name)
+            masks.extend(remove(img, session=session, only_mask=True) for img in images[start:])
+            break
+    return masks
+
+
+def _run_segment_batch(session, images: List[Image.Image], mean, std, size) -> List[Image.Image]:
+    """One inference over a stacked NCHW batch, split back into per-image masks"""
+    model_input = session.inner_session.get_inputs()[0]
+    if isinstance(model_input.shape[0], int) and model_input.shape[0] != len(images):
+        raise ValueError(f"model batch size is fixed at {model_input.shape[0]}")
+
+    batch = np.concatenate(
+        [session.normalize(img, mean, std, size)[model_input.name] for img in images], axis=0
+    )
+    preds = session.inner_session.run(None, {model_input.name: batch})[0][:, 0, :, :]
+
+    masks = []
+    for img, pred in zip(images, preds):
+        # Min-max per image, as the single-image predict does
+        lo, hi = np.min(pred), np.max(pred)
+        pred = (pred - lo) / (hi - lo)
+        mask = Image.fromarray((pred.clip(0, 1) * 255).astype("uint8"), mode="L")
+        masks.append(mask.resize(img.size, Image.Resampling.LANCZOS))
+    return masks
+
+
+def _segment_input(img: Image.Image, segment_size: Optional[int] = None) -> Image.Image:
+    """Small copy of `img` for segmentation - the network only sees ~320-1024px anyway"""
+    if segment_size is None:
+        segment_size = CUTOUT_SEGMENT_SIZE
+    small = img.copy()
+    if segment_size > 0:
+        small.thumbnail((segment_size, segment_size), Image.Resampling.BILINEAR)
+    return small
+
+
+def cutout_mask(img: Image.Image, fitted: Image.Image, quality: Optional[str] = None,
+                segment_size: Optional[int] = None) -> Image.Image:
+    """
+    Foreground alpha for `img`, returned at the size of `fitted` (img resized to its slot).
+    Raises if background removal is unavailable - callers decide on the fallback.
+    """
+    return cutout_masks([(img, fitted)], quality, segment_size)[0]
+
 
+def cutout_masks(items: List[Tuple[Image.Image, Image.Image]], quality: Optional[str] = None,
+                 segment_size: Optional[int] = None) -> List[Image.Image]:
+    """cutout_mask for several (img, fitted) pairs, segmented together as one batch"""
+    masks = segment_batch([_segment_input(img, segment_size) for img, _ in items], quality)
+    return [guided_upsample_mask(mask, fitted) for mask, (_, fitted) in zip(masks, items)]
 
-def create_cutout(img_bytes: bytes) -> Image.Image:
+
+def create_cutout(photo: Union[bytes, Image.Image], quality: Optional[str] = None,
+                  target_size: Optional[Tuple[int, int]] = None,
+                  segment_size: Optional[int] = None) -> Image.Image:
     """
     Remove background to create a professional cutout/sticker.
     SAFE VERSION: If it fails or is slow, it returns the original with luxury grading.
+
+    A single-photo cutout_mask: the photo (upload bytes or a decode_image result)
+    is fitted to `target_size` when given, and that image gets the alpha.
     """
     try:
-        print("LOG: Attempting Background Removal (this may take a moment)...")
-        # Use rembg with a quick check
-        output = remove(img_bytes)
-        return Image.open(io.BytesIO(output)).convert("RGBA")
+        img = photo if isinstance(photo, Image.Image) else decode_image(photo, target_size)
+        fitted = img.copy() if target_size is None else resize_to_fit(img, *target_size)
+        fitted.putalpha(cutout_mask(img, fitted, quality, segment_size))
+        return fitted
     except Exception as e:
         print(f"WARNING: Background removal skipped/failed: {e}")
         # Fallback: Just used the luxury graded image
-        img = apply_luxury_grade(img_bytes)
-        return img.convert("RGBA")
+        if target_size is not None:
+            return grade_to_fit(photo, *target_size).convert("RGBA")
+        if isinstance(photo, Image.Image):
+            return luxury_grade_image(photo).convert("RGBA")
+        return apply_luxury_grade(photo).convert("RGBA")
 
 
 def apply_watercolor_effect(img: Image.Image) -> Image.Image:
@@ -57,6 +273,23 @@ def apply_watercolor_effect(img: Image.Image) -> Image.Image:
         return img
 
 
+def outline_stroke_mask(alpha: Image.Image, width: int) -> Image.Image:
+    """
+    Round, anti-aliased stroke mask `width` px around the opaque area of `alpha`.
+    Uses a Euclidean distance transform, so the cost does not grow with the width
+    (a MaxFilter(2w+1) square kernel is O(w^2) per pixel and leaves square corners).
+    """
+    alpha_np = np.asarray(alpha)
+    # Distance from every pixel to the nearest solid (alpha >= 50%) pixel
+    outside = (alpha_np < 128).astype(np.uint8)
+    dist = cv2.distanceTransform(outside, cv2.DIST_L2, cv2.DIST_MASK_PRECISE)
+
+    # 1px linear ramp at the stroke boundary for a smooth edge
+    stroke = np.clip(width + 0.5 - dist, 0.0, 1.0) * 255.0
+    stroke = np.maximum(stroke, alpha_np)
+    return Image.fromarray(stroke.astype(np.uint8), mode="L")
+
+
 def add_doodle_outline(img: Image.Image, width: int = 20, color: str = "#FFFFFF") -> Image.Image:
     """
     Add a thick, slightly jittery white outline to an RGBA cutout.
@@ -67,9 +300,8 @@ def add_doodle_outline(img: Image.Image, width: int = 20, color: str = "#FFFFFF"
     # 1. Create a mask from the alpha channel
     alpha = img.split()[3]
     
-    # 2. Expand the alpha to create the stroke area
-    # MaxFilter is good for creating a clean expansion
-    stroke_mask = alpha.filter(ImageFilter.MaxFilter(width * 2 + 1))
+    # 2. Expand the alpha to create the stroke area (round distance-based dilation)
+    stroke_mask = outline_stroke_mask(alpha, width)
     
     # 3. Create the outline image
     r, g, b = hex_to_rgb(color)
@@ -89,44 +321,76 @@ def add_doodle_outline(img: Image.Image, width: int = 20, color: str = "#FFFFFF"
     return final
 
 
-def add_premium_shadow(img: Image.Image, offset: Tuple[int, int] = (20, 20), 
-                       blur_radius: int = 40) -> Image.Image:
+SHADOW_OFFSET = (20, 20)
+SHADOW_BLUR = 40
+SHADOW_OPACITY = 65  # Soft 65 alpha
+
+
+def premium_shadow_layer(alpha: Image.Image, offset: Tuple[int, int] = SHADOW_OFFSET,
+                         blur_radius: int = SHADOW_BLUR) -> Image.Image:
+    """
+    Black RGBA shadow for a photo with this alpha, padded by `blur_radius * 2` per side.
+    A radius-40 blur is a very low-frequency signal, so it is computed from the
+    alpha channel only on a downsampled copy and upscaled, instead of blurring
+    four full-resolution channels.
+    """
+    pad = blur_radius * 2
+    size = (alpha.width + pad * 2, alpha.height + pad * 2)
+
+    # Keep the low-res blur radius around 8px so the falloff stays smooth
+    factor = max(1, blur_radius // 8)
+    small = Image.new("L", (max(1, size[0] // factor), max(1, size[1] // factor)), 0)
+
+    # BOX resampling is an area average, so soft cutout edges survive the reduction
+    small_alpha = alpha.resize(
+        (max(1, alpha.width // factor), max(1, alpha.height // factor)), Image.Resampling.BOX
+    ).point(lambda v: v * SHADOW_OPACITY // 255)
+    small.paste(small_alpha, ((pad + offset[0]) // factor, (pad + offset[1]) // factor))
+
+    # Studio softness at low resolution, then a smooth upscale
+    small = small.filter(ImageFilter.GaussianBlur(blur_radius / factor))
+    shadow = Image.new("RGBA", size, (0, 0, 0, 0))
+    shadow.putalpha(small.resize(size, Image.Resampling.BILINEAR))
+    return shadow
+
+
+def add_premium_shadow(img: Image.Image, offset: Tuple[int, int] = SHADOW_OFFSET, 
+                       blur_radius: int = SHADOW_BLUR) -> Image.Image:
     """
     Studio-Grade Shadow: Deep, soft, and realistic.
+    Returns the photo on an enlarged canvas; the collage engine instead draws
+    premium_shadow_layer straight onto the collage.
     """
     # Expanded canvas for the soft blur spread
     pad = blur_radius * 2
-    bg_width = img.width + pad * 2
-    bg_height = img.height + pad * 2
-    
-    # 1. Create Shadow Alpha
-    shadow = Image.new("RGBA", (bg_width, bg_height), (0, 0, 0, 0))
+
     # Extract original alpha or create full white mask
     if img.mode == 'RGBA':
         alpha = img.split()[3]
     else:
         alpha = Image.new("L", img.size, 255)
-    
-    # 2. Draw Shadow Layer (Deep but transparent)
-    shadow_color = Image.new("RGBA", img.size, (0, 0, 0, 65)) # Soft 65 alpha
-    shadow.paste(shadow_color, (pad + offset[0], pad + offset[1]), mask=alpha)
-    
-    # 3. Apply Multi-Stage Gaussian Blur for 'Studio' softness
-    shadow = shadow.filter(ImageFilter.GaussianBlur(blur_radius))
-    
+
+    # 1-3. Low-resolution shadow from the alpha channel
+    shadow = premium_shadow_layer(alpha, offset, blur_radius)
+
     # 4. Paste Image Over Shadow
-    final = Image.new("RGBA", (bg_width, bg_height), (0, 0, 0, 0))
+    final = Image.new("RGBA", shadow.size, (0, 0, 0, 0))
     final.paste(img.convert("RGBA"), (pad, pad), mask=alpha)
     
     return Image.alpha_composite(shadow, final)
 
 
-def add_washi_tape(canvas: Image.Image, x: int, y: int, angle: float, color: str):
+def add_washi_tape(canvas: Image.Image, x: int, y: int, angle: float, color: str, scale: float = 1.0):
     """
     Add a realistic semi-transparent washi tape with torn edges.
+    `scale` matches the template scale (1.0 = Ultra-HD).
     """
-    tape_width = 120
-    tape_height = 40
+    def px(v):
+        return max(1, int(round(v * scale)))
+
+    tape_width = px(120)
+    tape_height = px(40)
+    inset, tear, step = px(5), px(10), px(4)
     
     # Create tape image
     tape = Image.new("RGBA", (tape_width, tape_height), (0, 0, 0, 0))
@@ -134,29 +398,37 @@ def add_washi_tape(canvas: Image.Image, x: int, y: int, angle: float, color: str
     
     # Main tape body with transparency
     r, g, b = hex_to_rgb(color)
-    draw.rectangle([5, 0, tape_width-5, tape_height], fill=(r, g, b, 160))
+    draw.rectangle([inset, 0, tape_width-inset, tape_height], fill=(r, g, b, 160))
     
     # Torn edges effect
-    for i in range(0, tape_height, 4):
-        draw.chord([0, i, 10, i+4], 90, 270, fill=(0, 0, 0, 0))
-        draw.chord([tape_width-10, i, tape_width, i+4], 270, 90, fill=(0, 0, 0, 0))
+    for i in range(0, tape_height, step):
+        draw.chord([0, i, tear, i+step], 90, 270, fill=(0, 0, 0, 0))
+        draw.chord([tape_width-tear, i, tape_width, i+step], 270, 90, fill=(0, 0, 0, 0))
         
     # Rotate and paste
     rotated_tape = tape.rotate(angle, expand=True, resample=Image.Resampling.BICUBIC)
     canvas.paste(rotated_tape, (x, y), rotated_tape)
 
 
-def add_hand_drawn_doodle(canvas: Image.Image, doodle_type: str, x: int, y: int, size: int, color: str):
+def add_hand_drawn_doodle(canvas: Image.Image, doodle_type: str, x: int, y: int, size: int, color: str,
+                          scale: float = 1.0, rng: Optional[random.Random] = None):
     """
     Draw a doodle that looks hand-drawn (jittery lines, varying thickness).
+    `size` is already in canvas pixels; `scale` (the template scale) thins the strokes to match.
+    The jitter comes from `rng` when given (to redraw the same strokes), else the global generator.
     """
+    rng = rng or random
     doodle_canvas = Image.new("RGBA", (size * 2, size * 2), (0, 0, 0, 0))
     draw = ImageDraw.Draw(doodle_canvas)
     r, g, b = hex_to_rgb(color)
     full_color = (r, g, b, 200)
     
     def jitter_point(p, j=2):
-        return (p[0] + random.randint(-j, j), p[1] + random.randint(-j, j))
+        j = max(1, int(round(j * scale)))
+        return (p[0] + rng.randint(-j, j), p[1] + rng.randint(-j, j))
+
+    def stroke(w):
+        return max(1, int(round(w * scale)))
     
     cx, cy = size, size
     
@@ -170,7 +442,7 @@ def add_hand_drawn_doodle(canvas: Image.Image, doodle_type: str, x: int, y: int,
                 hx = 16 * (np.sin(angle)**3)
                 hy = -(13 * np.cos(angle) - 5 * np.cos(2*angle) - 2 * np.cos(3*angle) - np.cos(4*angle))
                 points.append(jitter_point((cx + hx * size/25, cy + hy * size/25)))
-            draw.line(points, fill=full_color, width=random.randint(2, 4), joint="round")
+            draw.line(points, fill=full_color, width=stroke(rng.randint(2, 4)), joint="round")
 
     elif doodle_type == "star":
         for _ in range(2):
@@ -181,7 +453,7 @@ def add_hand_drawn_doodle(canvas: Image.Image, doodle_type: str, x: int, y: int,
                 px = cx + np.cos(angle) * radius
                 py = cy + np.sin(angle) * radius
                 points.append(jitter_point((px, py)))
-            draw.line(points, fill=full_color, width=random.randint(2, 4), joint="round")
+            draw.line(points, fill=full_color, width=stroke(rng.randint(2, 4)), joint="round")
             
     elif doodle_type == "squiggle":
         points = []
@@ -189,24 +461,26 @@ def add_hand_drawn_doodle(canvas: Image.Image, doodle_type: str, x: int, y: int,
             px = cx - size + (i * size * 2 / 9)
             py = cy + np.sin(i * 1.5) * (size/3)
             points.append(jitter_point((px, py), 4))
-        draw.line(points, fill=full_color, width=4, joint="round")
+        draw.line(points, fill=full_color, width=stroke(4), joint="round")
 
     # Paste onto main canvas
     canvas.paste(doodle_canvas, (x - size, y - size), doodle_canvas)
 
 
-def apply_super_resolution(img_cv: np.ndarray, max_dimension: int = 4000) -> np.ndarray:
+def apply_super_resolution(img_cv: np.ndarray, max_dimension: int = 4000,
+                           source_size: Optional[Tuple[int, int]] = None) -> np.ndarray:
     """
     ULTRA-HD Enhancement: Uses OpenCV detail enhancement for crisp output
     - Sharpens edges using unsharp masking
     - Enhances micro-details
     - Optimized for high-res collage output
+    `source_size` is the original upload size when `img_cv` was already resized.
     """
     try:
         h, w = img_cv.shape[:2]
 
-        # Only apply if image is below target resolution
-        if max(h, w) < max_dimension * 0.7:
+        # Only apply if the source image is below target resolution
+        if max(source_size or (w, h)) < max_dimension * 0.7:
             print(f"LOG: Applying super-resolution enhancement (size: {w}x{h})")
 
             # Method 1: Detail Enhancement using edge-preserving filter
@@ -223,23 +497,51 @@ def apply_super_resolution(img_cv: np.ndarray, max_dimension: int = 4000) -> np.
         return img_cv
 
 
-def apply_luxury_grade(image_bytes: bytes, enable_super_res: bool = True) -> Image.Image:
+def decode_image(image_bytes: bytes, target_size: Optional[Tuple[int, int]] = None) -> Image.Image:
+    """
+    Shared decode layer: upload bytes -> RGB pixels with EXIF orientation applied once.
+    - With `target_size` (the slot box), JPEGs are decoded directly at the
+      smallest 1/2, 1/4 or 1/8 DCT scale that still covers the fitted slot,
+      skipping most of the IDCT work and memory of a full 12MP decode
+    - The original upload size is kept in `img.info["source_size"]`
+    """
+    img = Image.open(io.BytesIO(image_bytes))
+    source_w, source_h = img.size
+    orientation = img.getexif().get(0x0112, 1)
+    rotated = orientation in (5, 6, 7, 8)
+
+    if target_size is not None and img.format == "JPEG":
+        box_w, box_h = target_size
+        if rotated:
+            # The slot is in display orientation, the JPEG is stored sideways
+            box_w, box_h = box_h, box_w
+        ratio = min(box_w / source_w, box_h / source_h)
+        if ratio < 0.5:
+            # +1 keeps the decode strictly larger than the slot, so resize_to_fit
+            # always downscales and never takes the sharpening upscale path
+            img.draft("RGB", (int(source_w * ratio) + 1, int(source_h * ratio) + 1))
+
+    img = ImageOps.exif_transpose(img).convert("RGB")
+    img.info["source_size"] = (source_h, source_w) if rotated else (source_w, source_h)
+    return img
+
+
+def luxury_grade_image(img: Image.Image, enable_super_res: bool = True,
+                       source_size: Optional[Tuple[int, int]] = None) -> Image.Image:
     """
     ULTRA-HD STUDIO ENHANCER: Professional photo enhancement pipeline
     - Super-resolution for low-res inputs (optional)
     - Bilateral Filtering for skin smoothing
     - CLAHE for adaptive brightness and detail
     - Multi-stage sharpening for crisp output
+    Run it on the photo already fitted to its slot - every filter here scales with pixel count.
     """
     try:
-        nparr = np.frombuffer(image_bytes, np.uint8)
-        img_cv = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-
-        if img_cv is None: raise ValueError("Decode Error")
+        img_cv = cv2.cvtColor(np.asarray(img.convert("RGB")), cv2.COLOR_RGB2BGR)
 
         # 0. Super-Resolution Enhancement (for low-res images)
         if enable_super_res:
-            img_cv = apply_super_resolution(img_cv)
+            img_cv = apply_super_resolution(img_cv, source_size=source_size)
 
         # 1. Bilateral Filter: Smooths skin while keeping edges sharp (Luxury Effect)
         img_cv = cv2.bilateralFilter(img_cv, 9, 75, 75)
@@ -266,9 +568,37 @@ def apply_luxury_grade(image_bytes: bytes, enable_super_res: bool = True) -> Ima
 
         return img_pil
 
+    except Exception as e:
+        print(f"Enhancement Warning: {e}")
+        return img
+
+
+def apply_luxury_grade(image_bytes: bytes, enable_super_res: bool = True) -> Image.Image:
+    """
+    Full-resolution grade straight from upload bytes.
+    Prefer decode -> resize_to_fit -> luxury_grade_image when the output size is known.
+    """
+    try:
+        img = decode_image(image_bytes)
     except Exception as e:
         print(f"Enhancement Warning: {e}")
         return Image.open(io.BytesIO(image_bytes))
+    return luxury_grade_image(img, enable_super_res)
+
+
+def grade_to_fit(photo: Union[bytes, Image.Image], max_width: int, max_height: int,
+                 enable_super_res: bool = True) -> Image.Image:
+    """
+    Resize-first grading: decode, fit to the slot, then grade at output resolution.
+    `photo` is upload bytes or an image already returned by decode_image.
+    """
+    if isinstance(photo, Image.Image):
+        img = photo
+    else:
+        img = decode_image(photo, (max_width, max_height))
+    source_size = img.info.get("source_size", img.size)
+    img = resize_to_fit(img, max_width, max_height)
+    return luxury_grade_image(img, enable_super_res, source_size=source_size)
 
 
 def apply_filter(img: Image.Image, filter_type: str) -> Image.Image:
@@ -341,19 +671,46 @@ def add_polaroid_frame(img: Image.Image, border_color: str = "white") -> Image.I
     return framed
 
 
-def add_studio_texture(img: Image.Image) -> Image.Image:
+GRAIN_TILE_SIZE = 512
+_grain_tiles = {}
+
+
+def get_grain_tile(seed: int = 0, size: int = GRAIN_TILE_SIZE) -> np.ndarray:
+    """
+    Process-wide cache of mid-gray film grain tiles (size x size x 3, uint8).
+    Generated once per seed; at a 4% blend the tiling is invisible.
+    """
+    key = (seed, size)
+    tile = _grain_tiles.get(key)
+    if tile is None:
+        # Uniform noise is much faster to generate than Normal distribution
+        noise = np.random.default_rng(seed).integers(-15, 15, (size, size), dtype=np.int16)
+        gray = (noise + 128).astype(np.uint8)
+        tile = np.ascontiguousarray(np.repeat(gray[:, :, None], 3, axis=2))
+        _grain_tiles[key] = tile
+    return tile
+
+
+def add_studio_texture(img: Image.Image, strength: float = 0.04, seed: int = 0) -> Image.Image:
     """
     Optimized physical texture generation.
+    Blends a cached grain tile into one RGB copy of the canvas, tile by tile,
+    instead of building full-canvas noise, stack and blend images per request.
     """
     try:
-        width, height = img.size
-        # Uniform noise is much faster to generate than Normal distribution
-        noise = np.random.randint(-15, 15, (height, width), dtype=np.int16)
-        noise_stack = np.stack([noise]*3, axis=-1)
-        # Shift to mid-gray and blend
-        noise_img = Image.fromarray(np.uint8(np.clip(noise_stack + 128, 0, 255)), mode='RGB')
-        
-        return Image.blend(img.convert("RGB"), noise_img.convert("RGB"), alpha=0.04)
+        canvas = np.array(img.convert("RGB"))
+        tile = get_grain_tile(seed)
+        tile_h, tile_w = tile.shape[:2]
+        height, width = canvas.shape[:2]
+
+        for y in range(0, height, tile_h):
+            for x in range(0, width, tile_w):
+                view = canvas[y:y + tile_h, x:x + tile_w]
+                grain = tile[:view.shape[0], :view.shape[1]]
+                # Same maths as Image.blend(img, noise, strength), written in place
+                cv2.addWeighted(view, 1.0 - strength, grain, strength, 0, dst=view)
+
+        return Image.fromarray(canvas)
     except Exception as e:
         print(f"Texture error: {e}")
         return img
@@ -364,13 +721,37 @@ def rotate_image(img: Image.Image, angle: float = None) -> Image.Image:
     return img.rotate(angle, expand=True, resample=Image.Resampling.BICUBIC)
 
 
+def create_gradient(width: int, height: int, colors: List[Tuple[int, int, int]],
+                    direction: str = "vertical") -> Image.Image:
+    """
+    ULTRA-HD Gradient: multi-stop vertical, horizontal or radial gradient.
+    - The ramp comes from Pillow's 256px built-in gradients resized in C
+    - Colour stops are applied as a 256-entry lookup table per channel
+    No per-pixel Python work, so a 3000x4000 canvas takes milliseconds.
+    """
+    if len(colors) == 1:
+        return Image.new("RGB", (width, height), tuple(colors[0]))
+
+    # 0 at the first stop, 255 at the last
+    if direction == "radial":
+        ramp = Image.radial_gradient("L")
+    elif direction == "horizontal":
+        ramp = Image.linear_gradient("L").transpose(Image.Transpose.ROTATE_90)
+    else:
+        ramp = Image.linear_gradient("L")
+    ramp = ramp.resize((width, height), Image.Resampling.BILINEAR)
+
+    # Evenly spaced stops -> per-channel lookup tables
+    stops = np.linspace(0, 255, len(colors))
+    levels = np.arange(256)
+    channels = np.asarray(colors, dtype=np.float32)
+    luts = [np.rint(np.interp(levels, stops, channels[:, c])).astype(np.uint8).tolist() for c in range(3)]
+
+    return Image.merge("RGB", [ramp.point(lut) for lut in luts])
+
+
 def create_gradient_background(width: int, height: int, color1: Tuple[int, int, int], color2: Tuple[int, int, int]) -> Image.Image:
-    base = Image.new("RGB", (width, height), color1)
-    top = Image.new("RGB", (width, height), color2)
-    mask = Image.new("L", (width, height))
-    mask.putdata([int(255 * (y / height)) for y in range(height) for _ in range(width)])
-    base.paste(top, (0, 0), mask)
-    return base
+    return create_gradient(width, height, [color1, color2], "vertical")
 
 
 def resize_to_fit(img: Image.Image, max_width: int, max_height: int) -> Image.Image:
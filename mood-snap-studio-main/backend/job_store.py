@@ -0,0 +1,344 @@
+"""
+Render Job Store
+SQLite-backed queue of collage jobs, so long renders no longer hold an HTTP connection open
+"""
+
+import os
+import json
+import time
+import uuid
+import shutil
+import sqlite3
+import asyncio
+import threading
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED = (DONE, FAILED, CANCELLED)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    params TEXT NOT NULL,
+    photo_count INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    analysis TEXT,
+    result TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created_at);
+"""
+
+
+class JobStore:
+    """
+    Jobs live in one SQLite database; each job's uploads and finished collage
+    live in its own directory next to it.
+    - Finished jobs are kept for JOB_RETENTION_SECONDS, and at most
+      JOB_MAX_FINISHED of them (oldest evicted first)
+    - Jobs that were running when the server stopped are queued again on start
+    """
+
+    def __init__(self, root: Optional[str] = None,
+                 retention: Optional[float] = None,
+                 max_finished: Optional[int] = None):
+        root = root or os.getenv("JOB_STORE_DIR") or str(Path(__file__).parent / "job_data")
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.retention = retention if retention is not None else float(os.getenv("JOB_RETENTION_SECONDS", "86400"))
+        self.max_finished = max_finished if max_finished is not None else int(os.getenv("JOB_MAX_FINISHED", "500"))
+
+        # Autocommit mode; multi-statement updates take an explicit transaction
+        self._db = sqlite3.connect(str(self.root / "jobs.sqlite3"), check_same_thread=False, isolation_level=None)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+
+    # ------------------------------------------------------------------
+    # Files
+    # ------------------------------------------------------------------
+    def job_dir(self, job_id: str) -> Path:
+        return self.root / job_id
+
+    def result_path(self, job_id: str) -> Path:
+        return self.job_dir(job_id) / "collage.png"
+
+    def photos(self, job_id: str) -> List[bytes]:
+        job = self.get(job_id)
+        if job is None:
+            return []
+        return [(self.job_dir(job_id) / f"photo_{i}").read_bytes() for i in range(job["photo_count"])]
+
+    # ------------------------------------------------------------------
+    # Lifecycle
+    # ------------------------------------------------------------------
+    def create(self, photos: List[bytes], params: Dict[str, Any]) -> str:
+        """Persist the uploads and queue a new job"""
+        job_id = uuid.uuid4().hex
+        job_dir = self.job_dir(job_id)
+        job_dir.mkdir(parents=True)
+        for i, photo in enumerate(photos):
+            (job_dir / f"photo_{i}").write_bytes(photo)
+
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO jobs (id, status, params, photo_count, created_at) VALUES (?, ?, ?, ?, ?)",
+                (job_id, QUEUED, json.dumps(params), len(photos), time.time())
+            )
+        return job_id
+
+    def claim_next(self) -> Optional[Dict[str, Any]]:
+        """Oldest queued job, atomically marked running (None if the queue is empty)"""
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._db.execute(
+                    "SELECT id FROM jobs WHERE status = ? ORDER BY created_at LIMIT 1", (QUEUED,)
+                ).fetchone()
+                if row is not None:
+                    self._db.execute(
+                        "UPDATE jobs SET status = ?, started_at = ? WHERE id = ?",
+                        (RUNNING, time.time(), row["id"])
+                    )
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        return self.get(row["id"]) if row is not None else None
+
+    def finish(self, job_id: str, status: str, analysis: Optional[dict] = None,
+               result: Optional[dict] = None, error: Optional[str] = None) -> bool:
+        """
+        Record the outcome of a running job. Returns False if the job is no
+        longer running (e.g. it was cancelled meanwhile) - the outcome is dropped.
+        """
+        with self._lock:
+            updated = self._db.execute(
+                "UPDATE jobs SET status = ?, finished_at = ?, analysis = ?, result = ?, error = ? "
+                "WHERE id = ? AND status = ?",
+                (status, time.time(),
+                 json.dumps(analysis) if analysis is not None else None,
+                 json.dumps(result) if result is not None else None,
+                 error, job_id, RUNNING)
+            ).rowcount
+        if updated:
+            self._remove_uploads(job_id)
+            if status != DONE:
+                self.result_path(job_id).unlink(missing_ok=True)
+        return bool(updated)
+
+    def save_result(self, job_id: str, write: Callable[[Path], Any]) -> bool:
+        """
+        `write(path)` the finished collage of a running job. It goes to a temp file
+        first and is only moved into place if the job was not cancelled meanwhile.
+        """
+        path = self.result_path(job_id)
+        partial = path.with_name(path.name + ".partial")
+        write(partial)
+        with self._lock:
+            row = self._db.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is not None and row["status"] == RUNNING:
+                partial.replace(path)
+                return True
+        partial.unlink(missing_ok=True)
+        return False
+
+    def cancel(self, job_id: str) -> Optional[str]:
+        """Cancel a queued or running job; returns its status afterwards (None if unknown)"""
+        with self._lock:
+            self._db.execute(
+                "UPDATE jobs SET status = ?, finished_at = ? WHERE id = ? AND status IN (?, ?)",
+                (CANCELLED, time.time(), job_id, QUEUED, RUNNING)
+            )
+        job = self.get(job_id)
+        if job is not None and job["status"] == CANCELLED:
+            self._remove_uploads(job_id)
+            self.result_path(job_id).unlink(missing_ok=True)
+        return job["status"] if job is not None else None
+
+    def requeue_interrupted(self) -> int:
+        """Jobs left running by a previous process go back to the queue"""
+        with self._lock:
+            return self._db.execute(
+                "UPDATE jobs SET status = ?, started_at = NULL WHERE status = ?", (QUEUED, RUNNING)
+            ).rowcount
+
+    # ------------------------------------------------------------------
+    # Queries
+    # ------------------------------------------------------------------
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        for field in ("params", "analysis", "result"):
+            job[field] = json.loads(job[field]) if job[field] else None
+        return job
+
+    def queue_position(self, job_id: str) -> Optional[int]:
+        """0-based position of a queued job (None if it is not queued)"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT created_at FROM jobs WHERE id = ? AND status = ?", (job_id, QUEUED)
+            ).fetchone()
+            if row is None:
+                return None
+            return self._db.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = ? AND created_at < ?", (QUEUED, row["created_at"])
+            ).fetchone()[0]
+
+    def count(self, status: str) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (status,)).fetchone()[0]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            rows = self._db.execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status").fetchall()
+        return {
+            "jobs": {row["status"]: row["n"] for row in rows},
+            "retention_seconds": self.retention,
+            "max_finished": self.max_finished,
+        }
+
+    # ------------------------------------------------------------------
+    # Retention
+    # ------------------------------------------------------------------
+    def evict(self) -> int:
+        """Drop finished jobs past their retention or beyond max_finished"""
+        placeholders = ",".join("?" * len(FINISHED))
+        with self._lock:
+            expired = self._db.execute(
+                f"SELECT id FROM jobs WHERE status IN ({placeholders}) AND finished_at < ?",
+                (*FINISHED, time.time() - self.retention)
+            ).fetchall()
+            overflow = self._db.execute(
+                f"SELECT id FROM jobs WHERE status IN ({placeholders}) ORDER BY finished_at DESC LIMIT -1 OFFSET ?",
+                (*FINISHED, self.max_finished)
+            ).fetchall()
+            job_ids = {row["id"] for row in expired} | {row["id"] for row in overflow}
+            for job_id in job_ids:
+                self._db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+        for job_id in job_ids:
+            shutil.rmtree(self.job_dir(job_id), ignore_errors=True)
+        if job_ids:
+            print(f"LOG: Evicted {len(job_ids)} finished render jobs")
+        return len(job_ids)
+
+    def _remove_uploads(self, job_id: str):
+        for path in self.job_dir(job_id).glob("photo_*"):
+            path.unlink(missing_ok=True)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class JobRunner:
+    """
+    Feeds queued jobs to `handler` on the event loop, at most `concurrency` at a
+    time. The handler returns (analysis, result) for a finished job; any
+    exception marks the job failed. Also runs retention sweeps.
+    """
+
+    def __init__(self, store: JobStore,
+                 handler: Callable[[Dict[str, Any]], Awaitable[tuple]],
+                 concurrency: Optional[int] = None,
+                 sweep_interval: Optional[float] = None):
+        self.store = store
+        self.handler = handler
+        self.concurrency = concurrency or int(os.getenv("JOB_CONCURRENCY", "2"))
+        self.sweep_interval = sweep_interval or float(os.getenv("JOB_SWEEP_INTERVAL", "60"))
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._wake: Optional[asyncio.Event] = None
+        self._loop_task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._wake = asyncio.Event()
+        requeued = self.store.requeue_interrupted()
+        if requeued:
+            print(f"LOG: Re-queued {requeued} render jobs interrupted by the last shutdown")
+        self._loop_task = asyncio.create_task(self._run())
+        print(f"LOG: Job runner started ({self.concurrency} concurrent jobs)")
+
+    async def stop(self):
+        tasks = list(self._tasks.values())
+        if self._loop_task is not None:
+            tasks.append(self._loop_task)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # Interrupted jobs are still marked running; the next start re-queues them
+        self._loop_task = None
+
+    def notify(self):
+        """A job was queued or a slot freed up"""
+        if self._wake is not None:
+            self._wake.set()
+
+    async def cancel(self, job_id: str) -> Optional[str]:
+        status = await asyncio.to_thread(self.store.cancel, job_id)
+        task = self._tasks.get(job_id)
+        if status == CANCELLED and task is not None:
+            # The render already on a worker runs out, but its result is dropped
+            task.cancel()
+        self.notify()
+        return status
+
+    async def _run(self):
+        last_sweep = 0.0
+        backoff = 1.0
+        while True:
+            try:
+                if time.monotonic() - last_sweep >= self.sweep_interval:
+                    await asyncio.to_thread(self.store.evict)
+                    last_sweep = time.monotonic()
+
+                while len(self._tasks) < self.concurrency:
+                    job = await asyncio.to_thread(self.store.claim_next)
+                    if job is None:
+                        break
+                    self._tasks[job["id"]] = asyncio.create_task(self._execute(job))
+                backoff = 1.0
+            except Exception as e:
+                # e.g. a locked or full database: keep the runner alive and try again
+                print(f"ERROR: Job runner failed to poll the queue, retrying in {backoff:.0f}s: {e}")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, self.sweep_interval)
+                continue
+
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.sweep_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+    async def _execute(self, job: Dict[str, Any]):
+        job_id = job["id"]
+        started = time.monotonic()
+        print(f"LOG: Job {job_id} started")
+        try:
+            analysis, result = await self.handler(job)
+            if await asyncio.to_thread(self.store.finish, job_id, DONE, analysis=analysis, result=result):
+                print(f"LOG: Job {job_id} done in {time.monotonic() - started:.1f}s")
+        except asyncio.CancelledError:
+            print(f"LOG: Job {job_id} cancelled")
+        except Exception as e:
+            print(f"ERROR: Job {job_id} failed: {e}")
+            try:
+                await asyncio.to_thread(self.store.finish, job_id, FAILED, error=str(e))
+            except Exception as db_err:
+                print(f"ERROR: Could not record the failure of job {job_id}: {db_err}")
+        finally:
+            self._tasks.pop(job_id, None)
+            self.notify()
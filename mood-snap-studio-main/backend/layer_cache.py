@@ -0,0 +1,256 @@
+"""
+Processed Photo Layer Cache
+Content-addressed cache for intermediate photo layers (decoded, graded, cutout alpha, final)
+so re-submitting the same photos under a new theme only pays for what changed
+"""
+
+import os
+import hashlib
+import threading
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, PngImagePlugin
+from typing import Any, Callable, Optional
+
+
+def photo_digest(photo_bytes: bytes) -> str:
+    """Content hash of an upload - the identity of a photo across requests"""
+    return hashlib.sha256(photo_bytes).hexdigest()
+
+
+def layer_key(stage: str, digest: str, params: Any) -> str:
+    """Cache key for one processing stage of one photo with the given parameters"""
+    return hashlib.sha256(f"{stage}|{digest}|{params!r}".encode()).hexdigest()
+
+
+def _image_bytes(img: Image.Image) -> int:
+    return img.width * img.height * len(img.getbands())
+
+
+class LayerCache:
+    """
+    Two-tier image cache.
+    - Memory: LRU bounded by decoded pixel bytes (LAYER_CACHE_MB)
+    - Disk (optional, LAYER_CACHE_DIR): lossless PNGs shared by every render
+      worker, evicted oldest-first once LAYER_CACHE_DISK_MB is exceeded.
+      Each process counts what it writes and only walks the directory when
+      that count passes the limit, so the tier can run over by what other
+      workers wrote since the last walk
+    Cached images are shared - callers must treat them as read-only.
+    """
+
+    def __init__(self,
+                 max_bytes: Optional[int] = None,
+                 disk_dir: Optional[str] = None,
+                 disk_max_bytes: Optional[int] = None):
+        if max_bytes is None:
+            max_bytes = int(os.getenv("LAYER_CACHE_MB", "256")) * 1024 * 1024
+        if disk_dir is None:
+            disk_dir = os.getenv("LAYER_CACHE_DIR", "")
+        if disk_max_bytes is None:
+            disk_max_bytes = int(os.getenv("LAYER_CACHE_DISK_MB", "2048")) * 1024 * 1024
+
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir or None
+        self.disk_max_bytes = disk_max_bytes
+        self._writer = None
+        self._disk_bytes = None  # running size of the disk tier, None until first walked
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            # PNG encoding is slow; persist in the background so renders never wait on it
+            self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="layer-cache-disk")
+
+        self._entries = OrderedDict()  # key -> (image, nbytes)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = defaultdict(int)
+        self.disk_hits = defaultdict(int)
+        self.misses = defaultdict(int)
+
+    # ------------------------------------------------------------------
+    # Public API
+    # ------------------------------------------------------------------
+    def get(self, stage: str, key: str) -> Optional[Image.Image]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits[stage] += 1
+                return entry[0]
+
+        img = self._disk_get(key)
+        if img is not None:
+            self._memory_put(key, img)
+            with self._lock:
+                self.disk_hits[stage] += 1
+            return img
+
+        with self._lock:
+            self.misses[stage] += 1
+        return None
+
+    def put(self, stage: str, key: str, img: Image.Image):
+        self._memory_put(key, img)
+        if self._writer is not None:
+            self._writer.submit(self._disk_put, key, img)
+
+    def get_or_create(self, stage: str, key: str, factory: Callable[[], Image.Image]) -> Image.Image:
+        img = self.get(stage, key)
+        if img is None:
+            img = factory()
+            self.put(stage, key, img)
+        return img
+
+    def contains(self, key: str) -> bool:
+        """Whether `key` is cached in either tier, without counting a hit or miss"""
+        with self._lock:
+            if key in self._entries:
+                return True
+        return bool(self.disk_dir) and os.path.exists(self._disk_path(key))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            stages = set(self.hits) | set(self.disk_hits) | set(self.misses)
+            return {
+                "entries": len(self._entries),
+                "memory_mb": round(self._bytes / (1024 * 1024), 1),
+                "memory_limit_mb": round(self.max_bytes / (1024 * 1024), 1),
+                "disk_dir": self.disk_dir,
+                "stages": {
+                    stage: {
+                        "hits": self.hits[stage],
+                        "disk_hits": self.disk_hits[stage],
+                        "misses": self.misses[stage],
+                    }
+                    for stage in sorted(stages)
+                },
+            }
+
+    # ------------------------------------------------------------------
+    # Memory tier
+    # ------------------------------------------------------------------
+    def _memory_put(self, key: str, img: Image.Image):
+        nbytes = _image_bytes(img)
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (img, nbytes)
+            self._bytes += nbytes
+            while self._bytes > self.max_bytes and self._entries:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= evicted
+
+    # ------------------------------------------------------------------
+    # Disk tier
+    # ------------------------------------------------------------------
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key[:2], f"{key}.png")
+
+    def _disk_get(self, key: str) -> Optional[Image.Image]:
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            with Image.open(path) as stored:
+                stored.load()
+                img = stored.copy()
+            os.utime(path)  # LRU by modification time
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"WARNING: Dropping unreadable cache entry {key[:12]}: {e}")
+            self._remove(path)
+            return None
+
+        # Restore the decode metadata the rest of the pipeline relies on
+        source_size = img.info.get("source_size")
+        if isinstance(source_size, str) and "x" in source_size:
+            w, h = source_size.split("x")
+            img.info["source_size"] = (int(w), int(h))
+        return img
+
+    def _disk_put(self, key: str, img: Image.Image):
+        path = self._disk_path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            meta = PngImagePlugin.PngInfo()
+            source_size = img.info.get("source_size")
+            if source_size:
+                meta.add_text("source_size", f"{source_size[0]}x{source_size[1]}")
+            img.save(tmp_path, format="PNG", compress_level=1, pnginfo=meta)
+            written = os.path.getsize(tmp_path)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            print(f"WARNING: Could not write cache entry {key[:12]}: {e}")
+            self._remove(tmp_path)
+            return
+
+        # Only the writer thread touches the running total
+        if self._disk_bytes is None:
+            self._disk_bytes = self._scan_disk()[1]
+        else:
+            self._disk_bytes += written
+        if self._disk_bytes > self.disk_max_bytes:
+            self._evict_disk()
+
+    def _scan_disk(self):
+        """(mtime, size, path) of every cached PNG, and their total size"""
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.disk_dir):
+            for name in files:
+                if not name.endswith(".png"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue  # evicted by another worker
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        return entries, total
+
+    def _evict_disk(self):
+        """Walk the disk tier and drop the oldest entries down to 90% of the limit"""
+        entries, total = self._scan_disk()
+        # The headroom keeps the next few writes from walking the directory again
+        target = self.disk_max_bytes * 9 // 10
+        if total > self.disk_max_bytes:
+            entries.sort()
+            for _, size, path in entries:
+                if total <= target:
+                    break
+                self._remove(path)
+                total -= size
+        self._disk_bytes = total
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+_layer_cache: Optional[LayerCache] = None
+_layer_cache_lock = threading.Lock()
+
+
+def get_layer_cache() -> LayerCache:
+    """Process-wide cache shared by every CollageEngine in this worker"""
+    global _layer_cache
+    if _layer_cache is None:
+        with _layer_cache_lock:
+            if _layer_cache is None:
+                _layer_cache = LayerCache()
+    return _layer_cache
@@ -0,0 +1,257 @@
+"""
+Render Worker Pool
+Runs CPU-bound collage rendering off the event loop with bounded admission
+"""
+
+import os
+import queue
+import asyncio
+import functools
+import dataclasses
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, List, Optional
+
+# Affinity keys remembered (most recent first); a forgotten key just picks a worker afresh
+AFFINITY_KEYS = 4096
+
+
+def _ping() -> int:
+    return os.getpid()
+
+
+def _drain(progress) -> list:
+    updates = []
+    while True:
+        try:
+            updates.append(progress.get_nowait())
+        except queue.Empty:
+            return updates
+
+
+def _call_soon(loop: asyncio.AbstractEventLoop, callback: Callable[[], Any]):
+    """Run `callback` on `loop` from an executor thread (no-op once the loop is closed)"""
+    try:
+        loop.call_soon_threadsafe(callback)
+    except RuntimeError:
+        pass
+
+
+class RenderPoolSaturated(Exception):
+    """All workers are busy and the wait queue is full (maps to HTTP 429)"""
+
+
+class RenderPoolUnavailable(Exception):
+    """The pool is not running or its workers died (maps to HTTP 503)"""
+
+
+@dataclasses.dataclass
+class _Lane:
+    """One executor and the renders admitted to it (a single process, or every thread worker)"""
+    executor: Executor
+    slots: asyncio.Semaphore
+    load: int = 0  # renders running or waiting on this lane
+
+
+class RenderPool:
+    """
+    Bounded executor for heavy renders.
+    - `max_workers` renders run at once (one per core by default)
+    - up to `max_queue` more wait in line on the event loop
+    - anything beyond that is rejected immediately instead of piling up
+
+    Process workers each get their own single-process executor (a lane), so a
+    render can be sent to a particular worker: runs sharing an `affinity` key
+    land on the worker that took the first of them, and find what it left in its
+    layer cache. Thread workers share one cache and one executor.
+    """
+
+    def __init__(self,
+                 max_workers: Optional[int] = None,
+                 max_queue: Optional[int] = None,
+                 kind: Optional[str] = None,
+                 initializer: Optional[Callable[[], Any]] = None):
+        self.max_workers = max_workers or int(os.getenv("RENDER_WORKERS", "0")) or os.cpu_count() or 1
+        if max_queue is None:
+            max_queue = int(os.getenv("RENDER_QUEUE_DEPTH", str(self.max_workers * 2)))
+        self.max_queue = max_queue
+        self.kind = (kind or os.getenv("RENDER_EXECUTOR", "process")).lower()
+        self.retry_after = int(os.getenv("RENDER_RETRY_AFTER", "5"))
+        self.initializer = initializer
+
+        self._lanes: List[_Lane] = []
+        self._context = None
+        self._manager = None
+        # affinity key -> lane index, most recently used last
+        self._affinity: "OrderedDict[str, int]" = OrderedDict()
+        self._admitted = 0
+        self._running = 0
+
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.restarts = 0
+
+    def start(self):
+        """Spin up the executors (called once from the app lifespan)"""
+        if self._lanes:
+            return
+        if self.kind == "thread":
+            executor = ThreadPoolExecutor(
+                max_workers=self.max_workers,
+                thread_name_prefix="render",
+                initializer=self.initializer
+            )
+            self._lanes = [_Lane(executor, asyncio.Semaphore(self.max_workers))]
+            self._warm_up(executor, self.max_workers)
+        else:
+            # 'spawn' keeps workers clear of the parent's event loop and ONNX threads
+            self._context = multiprocessing.get_context(os.getenv("RENDER_START_METHOD", "spawn"))
+            self._lanes = [_Lane(self._process_executor(), asyncio.Semaphore(1)) for _ in range(self.max_workers)]
+            if self._manager is None:
+                # Serves progress queues; starting it spawns a process, so never on a request
+                self._manager = self._context.Manager()
+        print(f"LOG: Render pool started ({self.kind}, {self.max_workers} workers, queue depth {self.max_queue})")
+
+    def _process_executor(self) -> ProcessPoolExecutor:
+        executor = ProcessPoolExecutor(max_workers=1, mp_context=self._context, initializer=self.initializer)
+        self._warm_up(executor, 1)
+        return executor
+
+    def _warm_up(self, executor: Executor, workers: int):
+        if self.initializer is not None:
+            # Start every worker now so its initializer (model warm-up) runs
+            # before the first real request lands on it
+            for _ in range(workers):
+                executor.submit(_ping)
+
+    def shutdown(self):
+        if self._manager is not None:
+            self._manager.shutdown()
+            self._manager = None
+        if not self._lanes:
+            return
+        for lane in self._lanes:
+            lane.executor.shutdown(wait=False, cancel_futures=True)
+        self._lanes = []
+        self._affinity.clear()
+        print("LOG: Render pool stopped")
+
+    async def progress_queue(self):
+        """
+        A queue render jobs can report progress on: a plain Queue for thread
+        workers, a proxy from the pool's Manager for process workers (created
+        off the event loop, it is an IPC round-trip). Read it with drain().
+        """
+        if self.kind == "thread":
+            return queue.Queue()
+        if self._manager is None:
+            raise RenderPoolUnavailable("Render pool is not running")
+        return await asyncio.to_thread(self._manager.Queue)
+
+    @staticmethod
+    async def drain(progress) -> list:
+        """Every update posted so far on a progress_queue(), read off the event loop"""
+        return await asyncio.to_thread(_drain, progress)
+
+    async def run(self, fn: Callable[..., Any], *args, affinity: Optional[str] = None, **kwargs) -> Any:
+        """
+        Run `fn(*args, **kwargs)` on a worker and await the result.
+        Runs with the same `affinity` key go to the same worker (the least loaded
+        one when the key is new), e.g. a render finishing a canvas an earlier run
+        left in that worker's layer cache.
+        Raises RenderPoolSaturated when the queue is full, RenderPoolUnavailable
+        when there is no healthy executor.
+        """
+        if not self._lanes:
+            raise RenderPoolUnavailable("Render pool is not running")
+
+        if self._admitted >= self.max_workers + self.max_queue:
+            self.rejected += 1
+            raise RenderPoolSaturated(
+                f"Render queue full ({self._running} running, {self._admitted - self._running} waiting)"
+            )
+
+        index = self._pick_lane(affinity)
+        lane = self._lanes[index]
+        self._admitted += 1
+        lane.load += 1
+        try:
+            # Waiting here (not inside the executor) keeps queued jobs cancellable
+            await lane.slots.acquire()
+        except BaseException:
+            self._admitted -= 1
+            lane.load -= 1
+            raise
+        self._running += 1
+        loop = asyncio.get_running_loop()
+
+        def release():
+            self._running -= 1
+            self._admitted -= 1
+            lane.load -= 1
+            lane.slots.release()
+
+        executor = lane.executor
+        future = None
+        try:
+            future = executor.submit(functools.partial(fn, *args, **kwargs))
+            # The slot is only given back once the worker is done with the job: a caller
+            # cancelled mid-render stops waiting (wrap_future then cancels the job if no
+            # worker picked it up yet), but a running render still occupies its worker
+            future.add_done_callback(lambda _: _call_soon(loop, release))
+            result = await asyncio.wrap_future(future)
+            self.completed += 1
+            return result
+        except BrokenProcessPool as e:
+            self.failed += 1
+            self._restart(lane, executor)
+            raise RenderPoolUnavailable(f"Render worker crashed: {e}") from e
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            if future is None:
+                release()
+
+    def _pick_lane(self, affinity: Optional[str]) -> int:
+        if affinity is not None and affinity in self._affinity:
+            self._affinity.move_to_end(affinity)
+            return self._affinity[affinity]
+        index = min(range(len(self._lanes)), key=lambda i: self._lanes[i].load)
+        if affinity is not None:
+            self._affinity[affinity] = index
+            while len(self._affinity) > AFFINITY_KEYS:
+                self._affinity.popitem(last=False)
+        return index
+
+    def _restart(self, lane: _Lane, broken: Executor):
+        """
+        Replace the broken worker process of `lane` so later requests can recover.
+        Every render that was on it fails with BrokenProcessPool; only the first
+        one to get here restarts, the rest find a new executor already in place.
+        The lane keeps its slots and affinity keys (the new worker starts with an
+        empty layer cache, so those renders just build everything again).
+        """
+        if lane.executor is not broken or lane not in self._lanes:
+            return
+        print("WARNING: Render worker broken, restarting it...")
+        self.restarts += 1
+        broken.shutdown(wait=False, cancel_futures=True)
+        lane.executor = self._process_executor()
+
+    def stats(self) -> dict:
+        return {
+            "kind": self.kind,
+            "running": bool(self._lanes),
+            "workers": self.max_workers,
+            "queue_depth": self.max_queue,
+            "active": self._running,
+            "waiting": self._admitted - self._running,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "restarts": self.restarts,
+        }
@@ -0,0 +1,77 @@
+"""
+Render Spec
+Serializable description of one collage render, so it can be repeated byte for byte without the analysis
+"""
+
+import json
+import hashlib
+import dataclasses
+from typing import Any, Dict, List
+
+from collage_templates import CollageTemplate, template_to_dict, template_from_dict
+
+# Bump whenever the renderer changes the pixels a given spec produces
+SPEC_VERSION = 1
+
+
+@dataclasses.dataclass
+class RenderSpec:
+    """
+    Everything that decides a collage's pixels: the template as rendered (already
+    scaled, with its placements and decorations), palette and emotion, the seed the
+    doodles are drawn from, and the SHA-256 of each photo in slot order.
+    The same spec with the same photos always renders the same bytes.
+    """
+    template: CollageTemplate
+    palette: List[str]
+    emotion: str
+    seed: int
+    photo_hashes: List[str]
+    version: int = SPEC_VERSION
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "version": self.version,
+            "template": template_to_dict(self.template),
+            "palette": list(self.palette),
+            "emotion": self.emotion,
+            "seed": self.seed,
+            "photo_hashes": list(self.photo_hashes),
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "RenderSpec":
+        """Parse a client-supplied spec; raises ValueError if it is malformed"""
+        try:
+            version = int(data.get("version", SPEC_VERSION))
+            if version != SPEC_VERSION:
+                raise ValueError(f"Unsupported spec version {version} (this server renders {SPEC_VERSION})")
+            seed = data["seed"]
+            if not isinstance(seed, int) or isinstance(seed, bool):
+                raise TypeError(f"seed must be an integer, got {seed!r}")
+            if not isinstance(data["emotion"], str):
+                raise TypeError(f"emotion must be a string, got {data['emotion']!r}")
+            for name in ("palette", "photo_hashes"):
+                if not isinstance(data[name], list) or not all(isinstance(item, str) for item in data[name]):
+                    raise TypeError(f"{name} must be a list of strings")
+            spec = cls(
+                template=template_from_dict(data["template"]),
+                palette=list(data["palette"]),
+                emotion=data["emotion"],
+                seed=seed,
+                photo_hashes=[h.lower() for h in data["photo_hashes"]],
+            )
+        except (KeyError, TypeError, AttributeError) as e:
+            raise ValueError(f"Malformed render spec: {e}") from e
+
+        if not spec.photo_hashes:
+            raise ValueError("Render spec lists no photos")
+        if len(spec.photo_hashes) > len(spec.template.placements):
+            raise ValueError(f"Render spec lists {len(spec.photo_hashes)} photos "
+                             f"for {len(spec.template.placements)} slots")
+        return spec
+
+    def spec_hash(self) -> str:
+        """SHA-256 of the canonical JSON form: the cache key and ETag of the render"""
+        canonical = json.dumps(self.to_dict(), sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(canonical.encode()).hexdigest()
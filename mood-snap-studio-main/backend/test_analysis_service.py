@@ -0,0 +1,93 @@
+import sys
+sys.path.insert(0, '.')
+
+from analysis_service import AnalysisCache, AnalysisService, CircuitBreaker, prepare_analysis_image
+from PIL import Image
+import asyncio
+import io
+import json
+import time
+
+# Gemini analysis guards, against a fake model: cancelling one request must
+# neither fail the requests coalesced with it nor leave the breaker half-open
+
+
+class FakeModel:
+    """generate_content stand-in; `mode` is 'fail', 'slow' or 'ok'"""
+
+    def __init__(self):
+        self.mode = "ok"
+        self.calls = 0
+
+    def generate_content(self, parts, request_options=None):
+        self.calls += 1
+        if self.mode == "fail":
+            raise RuntimeError("quota exceeded")
+        if self.mode == "slow":
+            time.sleep(0.5)
+        return type("Response", (), {"text": json.dumps({"dominantEmotion": "Joy", "colorPalette": ["#FFFFFF"]})})()
+
+
+def make_image():
+    buf = io.BytesIO()
+    Image.effect_noise((640, 480), 40).convert("RGB").save(buf, format="JPEG")
+    return prepare_analysis_image(buf.getvalue())
+
+
+async def main():
+    model = FakeModel()
+    service = AnalysisService(model, cache=AnalysisCache(ttl=0),
+                              breaker=CircuitBreaker(failure_threshold=1, cooldown=0.2), timeout=5)
+    image = make_image()
+
+    # Two requests share one call; the first one's client goes away
+    model.mode = "slow"
+    leader = asyncio.create_task(service.analyze(image, "doodle", "prompt"))
+    await asyncio.sleep(0.05)
+    follower = asyncio.create_task(service.analyze(image, "doodle", "prompt"))
+    await asyncio.sleep(0.05)
+    leader.cancel()
+    analysis = await follower
+    assert leader.cancelled()
+    assert analysis["dominantEmotion"] == "Joy", analysis
+    assert model.calls == 1 and service.flights.coalesced == 1
+    print(f"Follower of a cancelled leader got: {analysis['dominantEmotion']}")
+
+    # With every waiter gone, the shared call itself is cancelled
+    alone = asyncio.create_task(service.analyze(image, "doodle", "prompt"))
+    await asyncio.sleep(0.05)
+    alone.cancel()
+    await asyncio.sleep(0)
+    assert not service.flights._inflight
+
+    model.mode = "fail"
+    fallback = await service.analyze(image, "doodle", "prompt")
+    assert fallback["dominantEmotion"] == "Timeless"
+    assert service.breaker.state == CircuitBreaker.OPEN
+
+    # After the cooldown the probe goes out, and its request is cancelled mid-call
+    await asyncio.sleep(0.25)
+    model.mode = "slow"
+    probe = asyncio.create_task(service.analyze(image, "doodle", "prompt"))
+    await asyncio.sleep(0.1)
+    assert service.breaker.state == CircuitBreaker.HALF_OPEN
+    probe.cancel()
+    try:
+        await probe
+        raise AssertionError("probe was not cancelled")
+    except asyncio.CancelledError:
+        pass
+    await asyncio.sleep(0.01)
+
+    # The next call probes again and closes the circuit
+    model.mode = "ok"
+    calls = model.calls
+    analysis = await service.analyze(image, "doodle", "prompt")
+    assert model.calls == calls + 1, "breaker refused the next probe"
+    assert analysis["dominantEmotion"] == "Joy"
+    assert service.breaker.state == CircuitBreaker.CLOSED
+    print(f"Breaker after cancelled probe: {service.breaker.stats()['state']}")
+
+
+asyncio.run(main())
+print("SUCCESS! Analysis guards survive cancelled requests")
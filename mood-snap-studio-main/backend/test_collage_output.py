@@ -0,0 +1,50 @@
+import sys
+sys.path.insert(0, '.')
+
+from collage_output import CollageStore, EncoderSaturated, snap_quality
+from PIL import Image
+import asyncio
+import threading
+
+# Collage store output: nearby qualities share one encoding, and encodes run on
+# the store's own threads, with downloads beyond those threads plus their queue
+# rejected instead of piling up
+
+
+async def main():
+    assert snap_quality(None) is None
+    assert [snap_quality(q) for q in (1, 58, 83, 85, 95, 100)] == [50, 65, 80, 90, 100, 100]
+
+    store = CollageStore(encode_threads=1)
+    store.encode_queue = 1
+    collage_id = await store.run(store.put, Image.effect_noise((1200, 900), 40).convert("RGB"))
+
+    first = await store.download(collage_id, "jpeg", 83)
+    assert await store.download(collage_id, "jpeg", 79) is first
+    print(f"quality 83 and 79 share one encoding ({len(first)} bytes)")
+
+    # A long encode holds the only encoder thread, a download waits behind it
+    release = threading.Event()
+    blocker = asyncio.create_task(store.run(release.wait, 5))
+    waiting = asyncio.create_task(store.download(collage_id, "png"))
+    await asyncio.sleep(0.05)
+    assert store.stats()["encodes"] == 2, store.stats()
+    try:
+        await store.download(collage_id, "webp", 90)
+        raise AssertionError("queued a download beyond the encoder queue")
+    except EncoderSaturated as e:
+        print(f"Rejected: {e}")
+    # Cached encodings are still served, and the event loop's own threads stay free
+    assert await store.download(collage_id, "jpeg", 80) is first
+    assert await asyncio.wait_for(asyncio.to_thread(lambda: "free"), 1) == "free"
+
+    release.set()
+    await blocker
+    assert await waiting is not None
+    assert await store.download(collage_id, "webp", 90) is not None
+    await asyncio.sleep(0.05)
+    assert store.stats()["encodes"] == 0 and store.stats()["encode_rejected"] == 1, store.stats()
+
+
+asyncio.run(main())
+print("SUCCESS! Encodings are shared and bounded")
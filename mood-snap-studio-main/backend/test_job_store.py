@@ -0,0 +1,69 @@
+import sys
+sys.path.insert(0, '.')
+
+from job_store import JobRunner, JobStore, CANCELLED, DONE
+import asyncio
+import sqlite3
+import tempfile
+import threading
+
+# Job runner robustness: a database error while polling does not stop the
+# runner, and a job cancelled mid-render leaves no result file behind
+
+
+async def main(root):
+    store = JobStore(root=root)
+    rendering = threading.Event()
+    release = threading.Event()
+
+    def render(job):
+        if job["params"].get("slow"):
+            rendering.set()
+            release.wait(5)
+        return store.save_result(job["id"], lambda path: path.write_bytes(b"png"))
+
+    async def handler(job):
+        saved = await asyncio.to_thread(render, job)
+        return {"dominantEmotion": "Joy"}, ({"saved": True} if saved else None)
+
+    runner = JobRunner(store, handler, concurrency=1, sweep_interval=0.5)
+
+    # The first poll hits a locked database
+    claim_next = store.claim_next
+    failures = []
+
+    def flaky_claim():
+        if not failures:
+            failures.append(1)
+            raise sqlite3.OperationalError("database is locked")
+        return claim_next()
+
+    store.claim_next = flaky_claim
+    job_id = store.create([b"photo"], {"theme": "doodle"})
+    runner.start()
+    for _ in range(50):
+        await asyncio.sleep(0.1)
+        if store.get(job_id)["status"] == DONE:
+            break
+    assert failures and store.get(job_id)["status"] == DONE, store.get(job_id)
+    assert store.result_path(job_id).exists()
+    print("Runner recovered from a database error")
+
+    # Cancelled while the render thread is still running
+    slow_id = store.create([b"photo"], {"theme": "doodle", "slow": True})
+    runner.notify()
+    await asyncio.to_thread(rendering.wait, 5)
+    assert await runner.cancel(slow_id) == CANCELLED
+    release.set()
+    await asyncio.sleep(0.3)
+    leftovers = sorted(p.name for p in store.job_dir(slow_id).iterdir())
+    assert leftovers == [], leftovers
+    print("Cancelled job left no files")
+
+    await runner.stop()
+    store.close()
+
+
+with tempfile.TemporaryDirectory() as root:
+    asyncio.run(main(root))
+print("SUCCESS! Job runner survives errors and cleans up cancelled jobs")
@@ -0,0 +1,48 @@
+import sys
+sys.path.insert(0, '.')
+
+from collage_engine import CollageEngine
+from layer_cache import LayerCache
+from PIL import Image
+import io
+import random
+import time
+
+# One upload rendered in every style with CollageEngine.create_collages:
+# each photo is decoded once, and styles sharing a template render once
+
+print("Generating test photos...")
+photos = []
+for i in range(4):
+    img = Image.merge("RGB", [Image.effect_noise((4000, 3000), 20 + 5 * i + c) for c in range(3)])
+    buf = io.BytesIO()
+    img.save(buf, format='JPEG', quality=90)
+    photos.append(buf.getvalue())
+
+styles = ["scrapbook", "magazine", "moodboard", "filmstrip", "doodle", "sticker"]
+engine = CollageEngine(cache=LayerCache())
+
+start = time.time()
+collages = engine.create_collages(photos, styles, ["#FF6B6B", "#4ECDC4", "#FFE66D"], "Joy", scale=0.25)
+elapsed = time.time() - start
+
+assert list(collages) == styles
+# "scrapbook" selects the sticker template, so both styles share one render
+assert collages["scrapbook"] is collages["sticker"]
+assert len({id(c) for c in collages.values()}) == 5
+assert all(c.mode == "RGB" for c in collages.values())
+
+decoded = engine.cache.stats()["stages"]["decoded"]
+assert decoded["misses"] == len(photos), decoded
+
+# A later single-style render must not depend on the batch having warmed the cache
+for style in ["doodle", "magazine"]:
+    random.seed(5)
+    warm = engine.render_canvas(photos, style, ["#FF6B6B", "#4ECDC4", "#FFE66D"], "Joy", scale=0.25)
+    random.seed(5)
+    cold = CollageEngine(cache=LayerCache()).render_canvas(photos, style, ["#FF6B6B", "#4ECDC4", "#FFE66D"], "Joy", scale=0.25)
+    assert warm.tobytes() == cold.tobytes(), f"{style}: render depends on the batch cache"
+
+for style, collage in collages.items():
+    print(f"{style:<10} {collage.size}")
+print(f"SUCCESS! {len(styles)} styles in {elapsed:.2f}s, {decoded['misses']} decodes, {decoded['hits']} reused")
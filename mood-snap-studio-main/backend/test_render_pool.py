@@ -0,0 +1,92 @@
+import sys
+sys.path.insert(0, '.')
+
+from render_pool import RenderPool, RenderPoolSaturated, RenderPoolUnavailable
+import asyncio
+import os
+import time
+
+# Render pool admission: a cancelled caller whose render is already on a worker
+# must keep its slot until the worker is done, so the pool never runs more
+# renders than it has workers. Process workers: affinity keys pin renders to
+# one worker, and a crashed worker is replaced once
+
+
+def slow_render(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+def crash(delay):
+    time.sleep(delay)
+    os._exit(1)
+
+
+async def main():
+    pool = RenderPool(max_workers=1, max_queue=0, kind="thread")
+    pool.start()
+
+    running = asyncio.create_task(pool.run(slow_render, 0.5))
+    await asyncio.sleep(0.1)
+    running.cancel()
+    await asyncio.sleep(0.05)
+    assert running.cancelled()
+
+    # The worker is still busy with the cancelled render
+    assert pool.stats()["active"] == 1, pool.stats()
+    try:
+        await pool.run(slow_render, 0)
+        raise AssertionError("admitted a render while the only worker was busy")
+    except RenderPoolSaturated as e:
+        print(f"Rejected while the cancelled render runs out: {e}")
+
+    await asyncio.sleep(0.5)
+    assert pool.stats()["active"] == 0 and pool.stats()["waiting"] == 0, pool.stats()
+    assert await pool.run(slow_render, 0) == 0
+
+    # A queued caller cancelled before any worker picked it up frees its place at once
+    pool.max_queue = 1
+    first = asyncio.create_task(pool.run(slow_render, 0.3))
+    queued = asyncio.create_task(pool.run(slow_render, 0.3))
+    await asyncio.sleep(0.05)
+    queued.cancel()
+    await asyncio.sleep(0.05)
+    assert pool.stats()["waiting"] == 0, pool.stats()
+    assert await first == 0.3
+    print(f"Pool after cancellations: {pool.stats()}")
+    pool.shutdown()
+
+
+def worker_pid(seconds):
+    time.sleep(seconds)
+    return os.getpid()
+
+
+async def process_main():
+    pool = RenderPool(max_workers=2, max_queue=2, kind="process")
+    pool.start()
+
+    # Runs sharing an affinity key land on the same worker, even when another one is idle
+    first = await pool.run(worker_pid, 0, affinity="collage-a")
+    pids = await asyncio.gather(pool.run(worker_pid, 0.3, affinity="collage-a"),
+                                pool.run(worker_pid, 0.3, affinity="collage-a"))
+    assert pids == [first, first], (first, pids)
+    other = await asyncio.gather(pool.run(worker_pid, 0.3, affinity="collage-a"),
+                                 pool.run(worker_pid, 0.3, affinity="collage-b"))
+    assert other[0] == first and other[1] != first, other
+    print("Renders with one affinity key stay on one worker")
+
+    # One worker dies mid-render: only its render fails, and only that worker restarts
+    results = await asyncio.gather(pool.run(worker_pid, 1.0, affinity="collage-b"),
+                                   pool.run(crash, 0.5, affinity="collage-a"), return_exceptions=True)
+    assert results[0] == other[1] and isinstance(results[1], RenderPoolUnavailable), results
+    assert pool.stats()["restarts"] == 1, pool.stats()
+    assert await pool.run(worker_pid, 0, affinity="collage-a") not in (first, other[1])
+    print(f"Pool after a worker crash: {pool.stats()}")
+    pool.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
+    asyncio.run(process_main())
+    print("SUCCESS! Render slots, worker affinity and crash recovery hold up")
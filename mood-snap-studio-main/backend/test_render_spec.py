@@ -0,0 +1,84 @@
+import sys
+sys.path.insert(0, '.')
+
+from collage_engine import CollageEngine, render_collage_from_analysis, render_from_spec, spec_for_analysis, validate_spec
+from layer_cache import get_layer_cache
+from render_spec import RenderSpec
+from PIL import Image
+import copy
+import io
+import json
+import random
+
+# Render specs: the same spec and photos must give the same bytes, however warm
+# the layer cache is and whatever the global random state
+
+
+def make_photo(seed):
+    img = Image.merge("RGB", [Image.effect_noise((4000, 3000), 20 + 5 * seed + c) for c in range(3)])
+    buf = io.BytesIO()
+    img.save(buf, format='JPEG', quality=90)
+    return buf.getvalue()
+
+
+photos = [make_photo(i) for i in range(4)]
+palette = ["#FF6B6B", "#4ECDC4", "#FFE66D"]
+
+for style in ["doodle", "sticker", "magazine"]:
+    analysis = {"collageStyle": style, "colorPalette": palette, "dominantEmotion": "Joy"}
+    get_layer_cache().clear()
+    original = render_collage_from_analysis(photos, analysis, scale=0.25, seed=1234)
+
+    spec = spec_for_analysis(photos, analysis, 0.25, 1234)
+    parsed = RenderSpec.from_dict(json.loads(json.dumps(spec.to_dict())))
+    assert parsed.spec_hash() == spec.spec_hash()
+    validate_spec(parsed)
+
+    # Warm a fresh cache with layers decoded for every template at once, then re-render
+    get_layer_cache().clear()
+    CollageEngine().create_collages(photos, ["doodle", "sticker", "magazine", "filmstrip"], palette, "Joy", scale=0.25)
+    random.seed(99)
+    again = render_from_spec(parsed, photos)
+    assert again.tobytes() == original.tobytes(), f"{style}: spec render differs"
+
+    other = render_from_spec(RenderSpec.from_dict({**spec.to_dict(), "seed": 4321}), photos)
+    print(f"{style:<10} {spec.spec_hash()[:12]} identical, other seed differs: {other.tobytes() != original.tobytes()}")
+
+
+def tampered(change):
+    data = copy.deepcopy(spec.to_dict())
+    change(data)
+    return data
+
+
+for bad in [{}, {"version": 99}, {**spec.to_dict(), "photo_hashes": []}, {**spec.to_dict(), "seed": "1"},
+            tampered(lambda d: d["template"]["placements"][0].update(x="a"))]:
+    try:
+        RenderSpec.from_dict(bad)
+        raise AssertionError(f"accepted {bad}")
+    except ValueError as e:
+        print(f"Rejected: {e}")
+
+# Well-formed, but not a layout this server would render
+edited = tampered(lambda d: d["template"]["decorations"][0].update(content="Hello"))
+validate_spec(RenderSpec.from_dict(edited))
+for bad in [tampered(lambda d: d["template"].update(canvas_width=40000, canvas_height=40000)),
+            tampered(lambda d: d["template"].update(scale=8.0)),
+            tampered(lambda d: d["template"]["placements"][0].update(width=30000, height=30000)),
+            tampered(lambda d: d["template"]["placements"][0].update(cutout_quality="../model")),
+            tampered(lambda d: d["template"]["decorations"][0].update(font_size=5000)),
+            tampered(lambda d: d.update(palette=["red"]))]:
+    try:
+        validate_spec(RenderSpec.from_dict(bad))
+        raise AssertionError(f"accepted {bad['template']}")
+    except ValueError as e:
+        print(f"Rejected: {e}")
+
+# Every spec the server issues must pass its own validation, whatever the model answered
+for messy in [{"colorPalette": ["#FFF", "#000"]}, {"colorPalette": ["coral", "#4ecdc4", "not a color"]},
+              {"colorPalette": ["#101010"] * 20}, {"colorPalette": []}, {"dominantEmotion": ["Joy", "Calm"]}]:
+    issued = spec_for_analysis(photos, {"collageStyle": "doodle", **messy}, 0.25, 1234)
+    validate_spec(RenderSpec.from_dict(json.loads(json.dumps(issued.to_dict()))))
+    print(f"Issued spec for {messy}: palette {issued.palette[:3]}, emotion {issued.emotion!r}")
+
+print("SUCCESS! Spec renders are deterministic")
@@ -0,0 +1,81 @@
+import sys
+sys.path.insert(0, '.')
+
+from collage_engine import CollageEngine, RenderStateMissing, rerender_collage
+from PIL import Image, ImageChops
+import io
+import random
+import time
+
+# Incremental re-render: an edit through CollageEngine.rerender must match a
+# full render of the edited inputs, while only redoing the changed layer
+# (and still match when the layer cache no longer has the rest)
+
+
+def make_photo(seed):
+    img = Image.merge("RGB", [Image.effect_noise((2400, 1800), 20 + 5 * seed + c) for c in range(3)])
+    buf = io.BytesIO()
+    img.save(buf, format='JPEG', quality=90)
+    return buf.getvalue()
+
+
+photos = [make_photo(i) for i in range(4)]
+replacement = make_photo(9)
+palette = ["#FF6B6B", "#4ECDC4", "#FFE66D"]
+
+for style in ["doodle", "magazine", "sticker"]:
+    random.seed(7)
+    engine = CollageEngine(keep_state=True)
+    original = engine.render_canvas(photos, style, palette, "Joy", scale=0.25)
+    state = engine.render_state()
+
+    random.seed(7)
+    expected = CollageEngine().render_canvas([photos[0], replacement] + photos[2:], style, palette, "Joy", scale=0.25)
+
+    start = time.time()
+    swapped, swapped_state = rerender_collage(state, {1: replacement})
+    swap_time = time.time() - start
+    assert swapped.tobytes() == expected.tobytes(), f"{style}: photo swap differs from a full render"
+
+    # Sent without the uploads, while the worker still caches every layer
+    slim, slim_state = rerender_collage(state.without_photos(), {1: replacement})
+    assert slim.tobytes() == expected.tobytes(), f"{style}: edit without uploads differs"
+    assert slim_state.photos is None
+    assert state.after_edit(slim_state, {1: replacement}).photos == \
+        [replacement if i == 1 else photo for i, photo in enumerate(state.photos)]
+
+    # The state holds only the uploads; an edit on a worker with a cold cache rebuilds the rest
+    assert state.nbytes() <= sum(len(photo) for photo in photos)
+    engine.cache.clear()
+    cold, _ = rerender_collage(state, {1: replacement})
+    assert cold.tobytes() == expected.tobytes(), f"{style}: edit from a cold cache differs"
+    engine.cache.clear()
+    try:
+        rerender_collage(state.without_photos(), {1: replacement})
+        raise AssertionError("edited without uploads from a cold cache")
+    except RenderStateMissing:
+        pass
+
+    # A caption edit only touches the caption
+    captions = [i for i, d in enumerate(state.template.decorations) if d["type"] == "text"]
+    edited, _ = rerender_collage(swapped_state, decorations={captions[0]: {"content": "EDITED"}})
+    changed = ImageChops.difference(edited, swapped).getbbox()
+    assert changed is not None and changed[2] - changed[0] < edited.width // 2, changed
+
+    print(f"{style:<10} swap {swap_time:.2f}s, caption edit changed {changed}")
+
+doodle = next(i for i, d in enumerate(state.template.decorations) if d["type"] == "doodle")
+for bad_photos, bad_decorations in [
+    ({7: replacement}, None),
+    (None, {captions[0]: {"font_size": 10 ** 6}}),
+    (None, {doodle: {"size": 10 ** 7}}),
+    (None, {captions[0]: {"content": 42}}),
+    (None, {doodle: {"color": "red; x"}}),
+]:
+    try:
+        rerender_collage(state, bad_photos, bad_decorations)
+        raise AssertionError(f"accepted {bad_photos or bad_decorations}")
+    except ValueError as e:
+        print(f"Rejected: {e}")
+
+print("SUCCESS! Edits match full renders")
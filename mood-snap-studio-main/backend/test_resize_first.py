@@ -0,0 +1,46 @@
+import sys
+sys.path.insert(0, '.')
+
+from collage_templates import (
+    get_scrapbook_template, get_magazine_template, get_moodboard_template,
+    get_filmstrip_template, get_doodle_template, get_sticker_collage_template
+)
+from image_engine import apply_luxury_grade, resize_to_fit, grade_to_fit
+from PIL import Image
+import io
+import time
+
+# Before/after timing of the grading stage per template:
+#   legacy  = grade the full upload, then resize to the slot
+#   current = decode, resize to the slot, then grade at output resolution
+
+print("Generating 12MP test photo...")
+img = Image.merge("RGB", [Image.effect_noise((4000, 3000), 30 + 10 * i) for i in range(3)])
+buf = io.BytesIO()
+img.save(buf, format='JPEG', quality=90)
+photo_bytes = buf.getvalue()
+
+templates = [
+    get_scrapbook_template(6), get_magazine_template(6), get_moodboard_template(6),
+    get_filmstrip_template(6), get_doodle_template(6), get_sticker_collage_template(6),
+]
+
+print(f"{'Template':<12} {'Slots':>5} {'Legacy (s)':>11} {'Resize-first (s)':>17} {'Speedup':>8}")
+for template in templates:
+    slots = [p for p in template.placements if not p.use_cutout]
+    if not slots:
+        print(f"{template.name:<12} {0:>5}   (cutout-only template, see create_cutout)")
+        continue
+
+    start = time.time()
+    for placement in slots:
+        resize_to_fit(apply_luxury_grade(photo_bytes), placement.width, placement.height)
+    legacy = time.time() - start
+
+    start = time.time()
+    for placement in slots:
+        result = grade_to_fit(photo_bytes, placement.width, placement.height)
+        assert result.width <= placement.width and result.height <= placement.height
+    current = time.time() - start
+
+    print(f"{template.name:<12} {len(slots):>5} {legacy:>11.2f} {current:>17.2f} {legacy / current:>7.1f}x")
@@ -0,0 +1,80 @@
+import sys
+sys.path.insert(0, '.')
+
+import image_engine
+from image_engine import segment_batch, CUTOUT_MODELS
+from rembg import remove
+from rembg.sessions import sessions
+from PIL import Image
+import numpy as np
+
+# Batched segmentation against rembg's own single-image path: segment_batch
+# normalises with its copy of each model's inputs and reads the session's ONNX
+# graph directly, so every mask must still equal remove(..., only_mask=True).
+# The ONNX graph is faked (no model download), the session class is rembg's.
+
+
+class FakeInput:
+    def __init__(self, batch):
+        self.name = "input.1"
+        self.shape = [batch, 3, "height", "width"]
+
+
+class FakeGraph:
+    """Stands in for the ONNX InferenceSession: a per-pixel function of each image"""
+
+    def __init__(self, batch="batch_size"):
+        self.batch = batch
+        self.runs = 0
+
+    def get_inputs(self):
+        return [FakeInput(self.batch)]
+
+    def run(self, outputs, feed):
+        self.runs += 1
+        x = feed["input.1"]
+        # Nonlinear in every channel, so any drift in mean or std shows in the mask
+        return [np.tanh(x[:, :1]) * 0.7 + x[:, 1:2] ** 2 * 0.3 - x[:, 2:3] ** 3 * 0.1]
+
+
+def fake_session(model_name, graph):
+    session = sessions[model_name].__new__(sessions[model_name])
+    session.model_name = model_name
+    session.inner_session = graph
+    return session
+
+
+images = [
+    Image.effect_noise((640, 480), 60).convert("RGB"),
+    Image.radial_gradient("L").resize((300, 500)).convert("RGB"),
+    Image.merge("RGB", [Image.linear_gradient("L").resize((900, 700))] * 3),
+]
+
+for quality, model_name in CUTOUT_MODELS.items():
+    graph = FakeGraph()
+    image_engine._rembg_sessions[model_name] = fake_session(model_name, graph)
+
+    masks = segment_batch(images, quality)
+    assert graph.runs == 1, f"{model_name}: {graph.runs} runs for one batch"
+    for img, mask in zip(images, masks):
+        expected = remove(img, session=image_engine._rembg_sessions[model_name], only_mask=True)
+        assert mask.size == img.size and mask.mode == "L"
+        assert np.array_equal(np.asarray(mask), np.asarray(expected)), \
+            f"{model_name}: batched mask differs from rembg's for a {img.size} image"
+    print(f"{model_name}: {len(images)} batched masks match remove(only_mask=True)")
+
+# A graph with a fixed batch size falls back to one image at a time, for good
+model_name = CUTOUT_MODELS["standard"]
+graph = FakeGraph(batch=1)
+image_engine._rembg_sessions[model_name] = fake_session(model_name, graph)
+masks = segment_batch(images, "standard")
+assert model_name in image_engine._rembg_unbatched
+assert graph.runs == len(images)
+for img, mask in zip(images, masks):
+    expected = remove(img, session=image_engine._rembg_sessions[model_name], only_mask=True)
+    assert np.array_equal(np.asarray(mask), np.asarray(expected))
+graph.runs = 0
+segment_batch(images, "standard")
+assert graph.runs == len(images), graph.runs
+
+print("SUCCESS! Batched segmentation matches rembg image for image")